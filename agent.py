@@ -6,19 +6,21 @@ import time
 import tqdm
 import random
 import argparse
-import multiprocessing
 from datetime import datetime
 import asyncio
+from contextlib import asynccontextmanager
 
-from models.prompts import prompt_generator_agent
+from models.prompts import prompt_generator_agent, format_poi_info
 from processing.data import Dataset
 from models.llm_api import LLMWrapper
 from models.world_model import SpatialWorld, SocialWorld
-from models.personal_memory import Memory
+from models.personal_memory import Memory, LongTermStats
 from models.prompts import prompt_generator
 from utils import create_dir, extract_json, haversine_distance
-from config import PROXY, PROCESSED_DIR
-from run_llm_with_poi_mcp import _fetch_pois_via_mcp  # Importing the POI fetch logic
+from models.llm_cache import CACHE_MODES
+from models.batch_inference import BatchRunner, BATCH_BACKENDS
+from config import PROXY, PROCESSED_DIR, MCP_POOL_SIZE, LLM_CACHE_MODE, POI_TOKEN_BUDGET
+from run_llm_with_poi_mcp import _fetch_pois_via_mcp, MCPSessionPool  # Importing the POI fetch logic
 
 random.seed(100)
 
@@ -43,12 +45,15 @@ class Agent:
         save_dir,
         use_int_venue,
         social_info_type,
+        llm_model: LLMWrapper = None,
+        mcp_pool: MCPSessionPool = None,
+        poi_token_budget=POI_TOKEN_BUDGET,
     ):
         self.city_name = city_name
         self.platform = platform
         self.model_name = model_name
 
-        self.llm_model = LLMWrapper(model_name, platform)
+        self.llm_model = llm_model if llm_model is not None else LLMWrapper(model_name, platform)
         self.spatial_world = spatial_world
         self.social_world = social_world
         self.memory_unit = memory_unit
@@ -57,6 +62,8 @@ class Agent:
         self.save_dir = save_dir
         self.use_int_venue = use_int_venue
         self.social_info_type = social_info_type
+        self.mcp_pool = mcp_pool  # leased MCP sessions in the async engine, a fresh server per call otherwise
+        self.poi_token_budget = poi_token_budget
         self.stay_points = None  # Placeholder for stay points data, if needed elsewhere
 
     async def get_nearby_pois(self, prev_lat: float, prev_lon: float, repo_root: str) -> dict:
@@ -76,21 +83,17 @@ class Agent:
                 split_by_key=True,
                 compact=True,
                 include_tags=False,
+                pool=self.mcp_pool,
             )
             return pois
         except Exception as e:
             print(f"Failed to fetch POIs: {e}")
             return {}
 
-    def predict(self, user_id, traj_id, traj_seqs, target_stay, true_value, stay_points=None):
+    def build_prompt(self, user_id, traj_seqs, target_stay, poi_info):
         """
-        Predict the next POI based on trajectory sequences, fetched POIs, and stay points.
-        Returns:
-            dict: predictions dict with keys: input/output/prediction (+ optional metadata)
+        Assemble the final prompt from the world models, the personal memory and the fetched POIs.
         """
-        if stay_points is None:
-            stay_points = self.stay_points  # Use instance-level stay_points by default
-
         # Spatial world model info
         spatial_world_info = self.spatial_world.get_world_info()
 
@@ -100,17 +103,14 @@ class Agent:
         # Social world model
         last_venue_id = traj_seqs["context_stays"][-1][3]
         self_history_points = [x[3] for x in traj_seqs["context_stays"]]
+        target_time = (target_stay[0], target_stay[1]) if len(target_stay) >= 2 else None
         social_world_info = self.social_world.get_world_info(
-            last_venue_id, self_history_points, self.social_info_type
+            last_venue_id, self_history_points, self.social_info_type, target_time=target_time
         )
 
-        # Previous check-in point coordinates
-        prev_lat = traj_seqs["context_pos"][-1][1]
-        prev_lon = traj_seqs["context_pos"][-1][0]
-        repo_root = os.path.abspath(os.getcwd())
-
-        # Fetch nearby POIs asynchronously
-        poi_info = asyncio.run(self.get_nearby_pois(prev_lat, prev_lon, repo_root))
+        # Nearby POIs around the previous check-in, ranked and cut to the token budget
+        prev_lon, prev_lat = traj_seqs["context_pos"][-1][0], traj_seqs["context_pos"][-1][1]
+        poi_text = format_poi_info(poi_info, prev_lat, prev_lon, self.poi_token_budget)
 
         # Final prompt: add nearby POI info to the prompt
         prompt_text = prompt_generator_agent(
@@ -119,11 +119,45 @@ class Agent:
             spatial_world_info,
             memory_info,
             social_world_info,
-            poi_info,
+            poi_text,
         )
+        return prompt_text
 
-        pre_text = self.llm_model.get_response(prompt_text=prompt_text)
+    def predict(self, user_id, traj_id, traj_seqs, target_stay, true_value, stay_points=None):
+        """
+        Predict the next POI based on trajectory sequences, fetched POIs, and stay points.
+        Returns:
+            dict: predictions dict with keys: input/output/prediction (+ optional metadata)
+        """
+        # standalone entry point, Agents awaits apredict on its own event loop and MCP session pool
+        return asyncio.run(self.apredict(user_id, traj_id, traj_seqs, target_stay, true_value, stay_points))
+
+    async def apredict(self, user_id, traj_id, traj_seqs, target_stay, true_value, stay_points=None):
+        """
+        Async version of predict, awaited by Agents inside a single event loop.
+        The subdistrict query, the POI query and the nearby POI fetch are independent and run side by side.
+        """
+        if stay_points is None:
+            stay_points = self.stay_points  # Use instance-level stay_points by default
 
+        prev_lat = traj_seqs["context_pos"][-1][1]
+        prev_lon = traj_seqs["context_pos"][-1][0]
+        repo_root = os.path.abspath(os.getcwd())
+
+        if self.spatial_world.world_model:
+            poi_info = await self.get_nearby_pois(prev_lat, prev_lon, repo_root)
+        else:
+            poi_info, _ = await asyncio.gather(
+                self.get_nearby_pois(prev_lat, prev_lon, repo_root),
+                self.spatial_world.abuild_inner_world_model(),
+            )
+
+        prompt_text = self.build_prompt(user_id, traj_seqs, target_stay, poi_info)
+        pre_text = await self.llm_model.aget_response(prompt_text=prompt_text)
+        return self.parse_prediction(prompt_text, pre_text)
+
+    @staticmethod
+    def parse_prediction(prompt_text, pre_text):
         # Prediction results extraction
         # �ȳ��� prediction���ٶ��� recommendation����Ϊ��ԭʼ������ recommendation��
         output_json, prediction, reason = extract_json(pre_text, prediction_key="prediction")
@@ -165,6 +199,11 @@ class Agents:
         skip_existing_is_on=False,
         max_explore_places=5,
         max_sample_trajectories=1,
+        llm_cache_mode=None,
+        inference_mode="online",
+        batch_backend="vllm",
+        poi_token_budget=POI_TOKEN_BUDGET,
+        stream=False,
     ):
         self.city_name = city_name
         self.platform = platform
@@ -181,20 +220,31 @@ class Agents:
         self.skip_existing_is_on = skip_existing_is_on
         self.max_explore_places = max_explore_places
         self.max_sample_trajectories = max_sample_trajectories
+        self.poi_token_budget = poi_token_budget
 
-        # test_dictionary, true_locations
-        test_dataset, self.ground_data = dataset.get_generated_datasets()
+        # users are decoded lazily from the processed store, only the sampled ones are kept
+        self.dataset = dataset
+        self.ground_data = {}
         self.trajectories = []
         self.trajectory_groups = []
         self.known_stays = {}
+        # per user long term memory statistics, updated incrementally with known_stays
+        self.memory_stats = {}
         self.use_int_venue = use_int_venue
+        # number of trajectories predicted concurrently on one event loop, 1 predicts them one at a time
         self.workers = workers
+        # "batch" submits each stage's prompts as one offline batch, see models/batch_inference.py
+        self.inference_mode = inference_mode
+        self.batch_backend = batch_backend
+        # one LLMWrapper (and one set of HTTP clients) shared by every SpatialWorld and Agent of the run
+        self.llm_model = LLMWrapper(model_name, platform, cache_mode=llm_cache_mode, stream=stream)
+        self.mcp_pool = None
         self.save_dir = os.path.join(
             "results/", self.exp_name, self.city_name, "agentmove/", self.model_name, self.prompt_type
         )
         create_dir(self.save_dir)
 
-        self.trajs_sampling(test_dataset)
+        self.trajs_sampling(dataset)
 
         # ���·����ÿ��Ԥ��һ�� JSON
         #self.outputs_jsonl_path = os.path.join(self.save_dir, "predictions.jsonl")
@@ -203,11 +253,11 @@ class Agents:
         )   
 	    # self.outputs_jsonl_path = os.path.join("outputs", self.exp_name, self.city_name, self.model_name, self.prompt_type, "predictions.jsonl")
 
-    def trajs_sampling(self, test_dataset):
+    def trajs_sampling(self, dataset):
         counter = 0
-        user_list = [str(y) for y in sorted([int(x) for x in list(test_dataset.keys())])]
+        user_list = [str(y) for y in sorted([int(x) for x in dataset.get_user_ids()])]
         for user_id in user_list:
-            v = test_dataset[user_id]
+            v = dataset.get_user(user_id)
             traj_ids = [str(y) for y in sorted([int(x) for x in list(v.keys())])]
 
             if self.city_name in ["Shanghai"]:
@@ -232,6 +282,10 @@ class Agents:
 
             self.trajectory_groups.append(tuple(traj_list))
             self.known_stays[user_id] = v[traj_ids[0]]["historical_stays_long"]
+            input_lens = min(len(self.known_stays[user_id]), self.memory_lens)
+            self.memory_stats[user_id] = LongTermStats(self.memory_lens).extend(self.known_stays[user_id][-input_lens:])
+            ground_truth = dataset.get_ground_truth(user_id)
+            self.ground_data[user_id] = {traj_id: ground_truth[traj_id] for _, traj_id, _ in traj_list}
 
             if counter >= self.prompt_num:
                 print(
@@ -247,6 +301,10 @@ class Agents:
                 )
             )
 
+    def update_known_stays(self, user_id, stays):
+        self.known_stays[user_id].extend(stays)
+        self.memory_stats[user_id].extend(stays)
+
     def skip_existing_file(self, user_id, traj_id):
         filename = f"{self.model_name}_{self.prompt_type}_{user_id}_{traj_id}_{self.use_int_venue}.json"
         file_path = os.path.join(self.save_dir, filename)
@@ -268,65 +326,123 @@ class Agents:
                         "cat": point[2],
                         "pos": traj[2]["context_pos"][idx],
                     }
-                for user, trajs in self.ground_data.items():
-                    for traj_id, info in trajs.items():
-                        if int(info["ground_stay"]) not in stay_points:
-                            stay_points[int(info["ground_stay"])] = {
-                                "poi": int(info["ground_stay"]),
-                                "cat": None,
-                                "pos": info["ground_pos"],
-                            }
-
-        if self.workers == 1:
-            for traj in tqdm.tqdm(self.trajectories):
-                user_id, cur_context_stays = self.single_prediction(traj, stay_points, None)
-                self.known_stays[user_id].extend(cur_context_stays)
-        elif args.sample_one_traj_of_user:
-            with multiprocessing.Pool(self.workers) as pool:
-                _ = pool.starmap(
-                    self.single_prediction, [(traj, stay_points, None) for traj in self.trajectories]
-                )
+            # ground truth of every user, streamed once instead of once per trajectory
+            for user in self.dataset.get_user_ids():
+                for traj_id, info in self.dataset.get_ground_truth(user).items():
+                    if int(info["ground_stay"]) not in stay_points:
+                        stay_points[int(info["ground_stay"])] = {
+                            "poi": int(info["ground_stay"]),
+                            "cat": None,
+                            "pos": info["ground_pos"],
+                        }
+
+        if self.inference_mode == "batch":
+            asyncio.run(self.batch_predictions(stay_points))
         else:
-            raise NotImplementedError(
-                "Multiprocessing is not implemented yet, please use single process for now."
-            )
+            # workers == 1 is serial too, and still leases its POI lookups from the MCP session pool
+            asyncio.run(self.async_predictions(stay_points))
 
-    def single_prediction_group(self, trajs, shared_dict):
-        for traj in trajs:
-            user_id, cur_context_stays = self.single_prediction(traj, shared_dict)
-            with shared_dict["lock"]:
-                shared_dict["counter"][0] += 1
-                shared_dict["data"][user_id].extend(cur_context_stays)
+    async def async_predictions(self, stay_points):
+        """
+        Predict all sampled trajectories on one event loop, with at most `workers` trajectories in flight.
+        Trajectories of the same user stay sequential so that known_stays grows in trajectory order.
+        """
+        semaphore = asyncio.Semaphore(self.workers)
+        progress = tqdm.tqdm(total=len(self.trajectories))
 
-    def single_prediction(self, traj, stay_points, shared_dict=None):
-        user_id, traj_id, traj_seqs = traj
+        async def predict_group(trajs):
+            for traj in trajs:
+                async with semaphore:
+                    user_id, cur_context_stays = await self.async_single_prediction(traj, stay_points)
+                self.update_known_stays(user_id, cur_context_stays)
+                progress.update(1)
 
-        if self.skip_existing_is_on and self.skip_existing_file(user_id=user_id, traj_id=traj_id):
-            return (user_id, traj_seqs.get("context_stays", []))
+        try:
+            async with self.mcp_session_pool():
+                await asyncio.gather(*[predict_group(trajs) for trajs in self.trajectory_groups])
+        finally:
+            progress.close()
 
-        # spatial world model
-        spaital_world = SpatialWorld(
-            model_name=self.model_name,
-            platform=self.platform,
-            city_name=self.city_name,
-            traj_seqs=traj_seqs,
-            explore_num=self.max_explore_places,
-        )
+    async def batch_predictions(self, stay_points):
+        """
+        Offline batch mode: every prompt of a stage is submitted as one batch through BatchRunner.
+        Stage 1 sends all SpatialWorld prompts while the nearby POIs are fetched, stage 2 sends all final prompts.
+        Memory only depends on observed context stays, so known_stays is advanced up front in the serial order.
+        """
+        runner = BatchRunner(self.llm_model, backend=self.batch_backend, work_dir=os.path.join(self.save_dir, "batch"))
+        repo_root = os.path.abspath(os.getcwd())
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def fetch_pois(agent, traj_seqs):
+            async with semaphore:
+                return await agent.get_nearby_pois(traj_seqs["context_pos"][-1][1], traj_seqs["context_pos"][-1][0], repo_root)
+
+        async with self.mcp_session_pool():
+            jobs = []
+            for traj in self.trajectories:
+                user_id, traj_id, traj_seqs = traj
+                if not (self.skip_existing_is_on and self.skip_existing_file(user_id=user_id, traj_id=traj_id)):
+                    spaital_world = SpatialWorld(
+                        model_name=self.model_name,
+                        platform=self.platform,
+                        city_name=self.city_name,
+                        traj_seqs=traj_seqs,
+                        explore_num=self.max_explore_places,
+                        llm=self.llm_model,
+                        build_world=False,
+                    )
+                    jobs.append((traj, self.build_agent(user_id, traj_seqs, spaital_world)))
+                self.update_known_stays(user_id, traj_seqs.get("context_stays", []))
 
-        # personal memory
-        cur_context_stays = traj_seqs.get("context_stays", [])
-        target_stay = traj_seqs.get("target_stay", [])
+            world_prompts = {}
+            for (user_id, traj_id, _), agent in jobs:
+                for key, prompt_text in agent.spatial_world.world_model_prompts().items():
+                    world_prompts["{}_{}_{}".format(user_id, traj_id, key)] = prompt_text
 
-        if self.workers == 1 or self.sample_one_traj_of_user:
-            cur_know_stays = self.known_stays[user_id]
-        else:
-            with shared_dict["lock"]:
-                cur_know_stays = shared_dict["data"][user_id]
+            world_responses, *poi_infos = await asyncio.gather(
+                asyncio.to_thread(runner.run, world_prompts, "spatial_world"),
+                *[fetch_pois(agent, traj[2]) for traj, agent in jobs],
+            )
+
+        final_prompts = {}
+        for ((user_id, traj_id, traj_seqs), agent), poi_info in zip(jobs, poi_infos):
+            agent.spatial_world.world_model = {
+                key: world_responses["{}_{}_{}".format(user_id, traj_id, key)] for key in agent.spatial_world.world_model_prompts()
+            }
+            final_prompts["{}_{}".format(user_id, traj_id)] = agent.build_prompt(
+                user_id, traj_seqs, traj_seqs.get("target_stay", []), poi_info
+            )
+        final_responses = await asyncio.to_thread(runner.run, final_prompts, "prediction")
+
+        for (user_id, traj_id, traj_seqs), agent in jobs:
+            custom_id = "{}_{}".format(user_id, traj_id)
+            pred = agent.parse_prediction(final_prompts[custom_id], final_responses[custom_id])
+            self.save_prediction(user_id, traj_id, traj_seqs, self.ground_data[user_id][traj_id], pred)
+
+    @asynccontextmanager
+    async def mcp_session_pool(self):
+        repo_root = os.path.abspath(os.getcwd())
+        mcp_pool = MCPSessionPool(repo_root, size=min(self.workers, MCP_POOL_SIZE))
+        try:
+            await mcp_pool.start()
+            self.mcp_pool = mcp_pool
+        except Exception as e:
+            # same fallback as a failed POI fetch: keep predicting, one server per call
+            print(f"Failed to start MCP session pool: {e}")
+        try:
+            yield mcp_pool
+        finally:
+            self.mcp_pool = None
+            await mcp_pool.close()
 
+    def build_agent(self, user_id, traj_seqs, spaital_world):
+        # personal memory
+        cur_context_stays = traj_seqs.get("context_stays", [])
         memory_unit = Memory(
-            know_stays=cur_know_stays,
+            know_stays=self.known_stays[user_id],
             context_stays=cur_context_stays,
             memory_lens=self.memory_lens,
+            long_term_stats=self.memory_stats[user_id],
         )
 
         # agent
@@ -341,11 +457,36 @@ class Agents:
             save_dir=self.save_dir,
             use_int_venue=self.use_int_venue,
             social_info_type=self.social_info_type,
+            llm_model=self.llm_model,
+            mcp_pool=self.mcp_pool,
+            poi_token_budget=self.poi_token_budget,
         )
+        return agent
+
+    async def async_single_prediction(self, traj, stay_points):
+        user_id, traj_id, traj_seqs = traj
 
-        # predict
+        if self.skip_existing_is_on and self.skip_existing_file(user_id=user_id, traj_id=traj_id):
+            return (user_id, traj_seqs.get("context_stays", []))
+
+        spaital_world = SpatialWorld(
+            model_name=self.model_name,
+            platform=self.platform,
+            city_name=self.city_name,
+            traj_seqs=traj_seqs,
+            explore_num=self.max_explore_places,
+            llm=self.llm_model,
+            build_world=False,
+        )
+        agent = self.build_agent(user_id, traj_seqs, spaital_world)
+
+        target_stay = traj_seqs.get("target_stay", [])
         true_value = self.ground_data[user_id][traj_id]
-        pred = agent.predict(user_id, traj_id, traj_seqs, target_stay, true_value, stay_points)
+        pred = await agent.apredict(user_id, traj_id, traj_seqs, target_stay, true_value, stay_points)
+        return self.save_prediction(user_id, traj_id, traj_seqs, true_value, pred)
+
+    def save_prediction(self, user_id, traj_id, traj_seqs, true_value, pred):
+        cur_context_stays = traj_seqs.get("context_stays", [])
 
         # ��װ�����next check-in = predicted next POI id (top1)
         prev_lat = traj_seqs["context_pos"][-1][1]
@@ -401,7 +542,7 @@ if __name__ == "__main__":
         "--platform",
         type=str,
         default="SiliconFlow",
-        choices=["SiliconFlow", "OpenAI", "DeepInfra", "vllm", "OpenRouter", "TogetherAI"],
+        choices=["SiliconFlow", "OpenAI", "DeepInfra", "vllm", "OpenRouter", "TogetherAI", "router"],
     )
     parser.add_argument("--trajectory_mode", type=str, default="trajectory_split", choices=["trajectory_split"])
     parser.add_argument("--historical_stays", type=int, default=15)
@@ -418,13 +559,24 @@ if __name__ == "__main__":
         default="agent_move_v6",
         choices=["agent_move_v6", "origin", "llmmob", "llmzs", "llmmove"],
     )
-    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=1, help="Max trajectories predicted concurrently (asyncio), 1 runs serially")
     parser.add_argument("--exp_name", type=str, default="")
     parser.add_argument("--social_info_type", type=str, default="address")
     parser.add_argument("--memory_lens", type=int, default=15)
     parser.add_argument("--skip_existing_prediction", action="store_true")
     parser.add_argument("--max_neighbors", type=int, default=10)
     parser.add_argument("--max_explore_places", type=int, default=5)
+    parser.add_argument(
+        "--llm_cache",
+        type=str,
+        default=LLM_CACHE_MODE,
+        choices=CACHE_MODES,
+        help="LLM response cache, read_only serves cached responses without writing new ones",
+    )
+    parser.add_argument("--inference_mode", type=str, default="online", choices=["online", "batch"])
+    parser.add_argument("--batch_backend", type=str, default="vllm", choices=BATCH_BACKENDS)
+    parser.add_argument("--poi_token_budget", type=int, default=POI_TOKEN_BUDGET, help="Max tokens of the nearby POI table in the prompt")
+    parser.add_argument("--stream", action="store_true", help="Stream LLM responses and stop as soon as the prediction JSON is complete")
 
     args = parser.parse_args()
     print("INFO START TIME:{}".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
@@ -474,7 +626,19 @@ if __name__ == "__main__":
         skip_existing_is_on=args.skip_existing_prediction,
         max_explore_places=args.max_explore_places,
         max_sample_trajectories=args.max_sample_trajectories,
+        llm_cache_mode=args.llm_cache,
+        inference_mode=args.inference_mode,
+        batch_backend=args.batch_backend,
+        poi_token_budget=args.poi_token_budget,
+        stream=args.stream,
     )
 
     agents.get_predictions()
+    print("LLM cache:{}".format(agents.llm_model.cache.stats()))
+    print("LLM tokens:{}".format(agents.llm_model.token_metrics.stats()))
+    print("LLM rate limiter:{}".format(agents.llm_model.rate_limiter.stats()))
+    if agents.llm_model.router is not None:
+        print("LLM routing:{}".format(agents.llm_model.router.stats()))
+    if args.stream:
+        print("LLM streaming:{}".format(agents.llm_model.stream_metrics.stats()))
     print("runnning experiment within {} seconds".format(int(time.time() - start_time)))
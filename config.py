@@ -43,5 +43,47 @@ WAIT_TIME_MAX = 60
 ATTEMPT_COUNTER = 10
 VLLM_URL = "xxx" # vllm serving API URL settings
 
+# LLM response cache, see models/llm_cache.py
+LLM_CACHE_PATH = "results/llm_cache.sqlite"
+LLM_CACHE_MODE = "read_write" # off, read_write, read_only (reproducible benchmarks, never writes)
+LLM_CACHE_MAX_SIZE_MB = 2048 # least recently used entries beyond this size are evicted
+LLM_CACHE_MAX_AGE_DAYS = 90
+
+# Shared LLM HTTP connection pools, see models/llm_api.LLMClientRegistry
+LLM_POOL_SIZES = {"vllm": 256, "TogetherAI": 64, "DeepInfra": 64} # max connections per platform
+LLM_POOL_DEFAULT_SIZE = 32
+LLM_HTTP2 = True # only used when the h2 package is installed (pip install httpx[http2])
+
+# Adaptive per (platform, model) rate limits, see models/rate_limiter.py; 0 disables a limit
+LLM_RATE_LIMITS = {
+    "vllm": {"rpm": 0, "tpm": 0, "max_concurrency": 0},
+    "TogetherAI": {"rpm": 600, "tpm": 1000000, "max_concurrency": 50},
+    "DeepInfra": {"rpm": 600, "tpm": 1000000, "max_concurrency": 50},
+}
+LLM_RATE_LIMIT_DEFAULT = {"rpm": 300, "tpm": 500000, "max_concurrency": 32}
+
+# Multi-provider routes of a logical model, see models/llm_router.py; the first deployment is the primary.
+# "model" is a short name of models/llm_api.LLMAPI, prices are USD per 1M prompt / completion tokens
+LLM_ROUTES = {
+    "llama3.3-70b": [
+        {"platform": "TogetherAI", "model": "llama3.3-70b-together", "price_in": 0.88, "price_out": 0.88},
+        {"platform": "DeepInfra", "model": "llama3.3-70b-deepinfra", "price_in": 0.23, "price_out": 0.40},
+        {"platform": "vllm", "model": "llama3.3-70b-vllm", "price_in": 0.0, "price_out": 0.0},
+    ],
+}
+LLM_HEDGE_PERCENTILE = 95 # the next deployment gets a duplicate once a request is slower than this latency percentile
+LLM_HEDGE_MIN_SAMPLES = 20 # below this many latency samples LLM_HEDGE_DEFAULT_DELAY_S is used
+LLM_HEDGE_DEFAULT_DELAY_S = 10
+LLM_FAILOVER_COOLDOWN_S = 30 # a deployment that failed is tried last for this long
+LLM_ROUTE_LATENCY_SLACK = 0.2 # the cheapest deployment within 20% of the fastest median latency goes first
+
+# Offline batch inference, see models/batch_inference.py
+BATCH_POLL_INTERVAL = 10 # seconds between status polls of an OpenAI-style batch job
+BATCH_COMPLETION_WINDOW = "24h"
+
+# MCP POI server
+MCP_POOL_SIZE = 8 # Max long-lived osm_poi_server sessions shared by the async prediction engine
+POI_TOKEN_BUDGET = 400 # Max tokens of the nearby POI table in the agent prompt, see models/prompts.format_poi_info
+
 
 OFFSET_DICT = {'Tokyo':540, 'Moscow':180, 'SaoPaulo':-180, 'Shanghai':480, 'Shanghai_ISP':480, 'Shanghai_Weibo':480}
\ No newline at end of file
@@ -1,16 +1,42 @@
 from __future__ import annotations
 
+import os
 from dataclasses import asdict
 from collections import Counter
 from typing import Any, Dict, List, Optional
 
 from mcp.server.fastmcp import FastMCP
 
-from models.osm_poi import fetch_pois_osm_overpass, POI
+from models.osm_poi import get_overpass_client, POI, DEFAULT_POI_KEYS
+from models.osm_poi_index import OSMPOIIndex, DEFAULT_INDEX_PATH
+from models.poi_cache import POICache, filter_pois
 
 
 mcp = FastMCP("AgentMove-OSM-POI")
 
+# offline index built by `python -m models.osm_poi_index`, Overpass is used when it does not exist
+# or when the query reaches outside of the extract it was built from
+POI_INDEX_PATH = os.environ.get("OSM_POI_INDEX_PATH", DEFAULT_INDEX_PATH)
+_poi_index: Optional[OSMPOIIndex] = None
+
+
+def _get_poi_index() -> Optional[OSMPOIIndex]:
+    global _poi_index
+    if _poi_index is None and os.path.exists(POI_INDEX_PATH):
+        _poi_index = OSMPOIIndex.load(POI_INDEX_PATH)
+    return _poi_index
+
+
+# Overpass results are cached on disk per geohash cell, shared by all server processes
+_poi_cache: Optional[POICache] = None
+
+
+def _get_poi_cache() -> POICache:
+    global _poi_cache
+    if _poi_cache is None:
+        _poi_cache = POICache()
+    return _poi_cache
+
 
 def _poi_to_compact(p: POI) -> Dict[str, Any]:
     return {
@@ -35,7 +61,7 @@ def _pois_to_jsonable(pois: List[POI], compact: bool, include_tags: bool) -> Lis
 
 
 @mcp.tool()
-def get_nearby_pois(
+async def get_nearby_pois(
     lat: float,
     lon: float,
     radius_m: int = 500,
@@ -48,20 +74,42 @@ def get_nearby_pois(
     include_tags: bool = False,
 ) -> Dict[str, Any]:
     """
-    OSM POI query tool (Overpass).
+    OSM POI query tool (offline index when built and covering the query, Overpass otherwise).
     Default is compact output for LLM friendliness.
     """
-    pois = fetch_pois_osm_overpass(
-        lat=lat,
-        lon=lon,
-        radius_m=radius_m,
-        poi_keys=poi_keys,
-        name_query=name_query,
-	osm_types=["node"],
-        limit=limit,
-        timeout_overpass_s=timeout_overpass_s,
-        split_by_key=split_by_key,
-    )
+    poi_index = _get_poi_index()
+    if poi_index is not None and poi_index.covers(lat, lon, radius_m):
+        pois = poi_index.query(
+            lat=lat,
+            lon=lon,
+            radius_m=radius_m,
+            poi_keys=poi_keys,
+            name_query=name_query,
+            osm_types=["node"],
+            limit=limit,
+            split_by_key=split_by_key,
+        )
+    else:
+        poi_keys = poi_keys or DEFAULT_POI_KEYS
+        poi_cache = _get_poi_cache()
+        pois = poi_cache.get(lat, lon, radius_m, poi_keys, name_query, limit, split_by_key, ["node"])
+        if pois is None:
+            # query around the cell center with a radius covering every point snapped to this cell,
+            # then keep what is inside the radius of the real point
+            center_lat, center_lon, fetch_radius_m, fetch_limit = poi_cache.fetch_params(lat, lon, radius_m, limit)
+            fetched = await get_overpass_client().fetch_pois(
+                lat=center_lat,
+                lon=center_lon,
+                radius_m=fetch_radius_m,
+                poi_keys=poi_keys,
+                name_query=name_query,
+                osm_types=["node"],
+                limit=fetch_limit,
+                timeout_overpass_s=timeout_overpass_s,
+                split_by_key=split_by_key,
+            )
+            poi_cache.put(lat, lon, radius_m, poi_keys, name_query, limit, split_by_key, ["node"], fetched)
+            pois = filter_pois(fetched, lat, lon, radius_m, poi_keys, name_query, limit, split_by_key)
 
     counts = Counter(f"{p.category}={p.value}" for p in pois if p.category and p.value)
     top_counts = [{"type": k, "count": v} for k, v in counts.most_common(30)]
@@ -75,6 +123,14 @@ def get_nearby_pois(
     }
 
 
+@mcp.tool()
+def get_overpass_latency_stats() -> Dict[str, Any]:
+    """
+    Per Overpass endpoint: recent successful requests, errors, hedged races won and p50/p95 latency in ms.
+    """
+    return get_overpass_client().latency_stats()
+
+
 def main() -> None:
     # stdio server
     mcp.run()
@@ -0,0 +1,115 @@
+import os
+import sys
+import json
+import time
+import subprocess
+
+from config import BATCH_POLL_INTERVAL, BATCH_COMPLETION_WINDOW
+
+
+BATCH_BACKENDS = ["vllm", "openai"]
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+
+def write_batch_file(path, requests):
+    """requests: list of (custom_id, body) in the OpenAI batch JSONL format."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        for custom_id, body in requests:
+            f.write(json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}, ensure_ascii=False) + "\n")
+
+
+def custom_id_order(custom_id):
+    """sort key of a custom_id "{user_id}_{traj_id}[_{key}]", numeric parts compare as numbers"""
+    return tuple((0, int(p), "") if p.isdigit() else (1, 0, p) for p in custom_id.split("_"))
+
+
+def iter_batch_results(path):
+    """Stream (custom_id, text) from a batch output file, text is None for failed requests."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            try:
+                text = record["response"]["body"]["choices"][0]["message"]["content"]
+            except (KeyError, IndexError, TypeError):
+                text = None
+            yield record["custom_id"], text
+
+
+class BatchRunner:
+    """
+    Offline batch inference for one run stage (e.g. all SpatialWorld prompts, then all final prompts).
+
+    The prompts of a stage are written to one JSONL file in the OpenAI batch format and submitted at once,
+    either to a local vLLM engine (vllm.entrypoints.openai.run_batch, which schedules the whole file with
+    continuous batching) or to the /v1/batches endpoint of the platform behind the LLMWrapper. Cached prompts
+    are not resubmitted and failed requests fall back to LLMWrapper.get_response.
+    """
+    def __init__(self, llm, backend="vllm", work_dir="results/batch", poll_interval=BATCH_POLL_INTERVAL):
+        if backend not in BATCH_BACKENDS:
+            raise ValueError(f"Invalid batch backend:{backend}, please use one of {BATCH_BACKENDS}")
+        self.llm = llm
+        self.backend = backend
+        self.work_dir = work_dir
+        self.poll_interval = poll_interval
+
+    def submit_vllm(self, input_path, output_path):
+        # vllm is an optional dependency, only needed on the serving machine
+        cmd = [sys.executable, "-m", "vllm.entrypoints.openai.run_batch",
+               "-i", input_path, "-o", output_path, "--model", self.llm.api_model_name]
+        subprocess.run(cmd, check=True)
+
+    def submit_openai(self, input_path, output_path):
+        client = self.llm.client
+        with open(input_path, "rb") as f:
+            input_file = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(
+            input_file_id=input_file.id, endpoint=BATCH_ENDPOINT, completion_window=BATCH_COMPLETION_WINDOW
+        )
+        while batch.status not in ["completed", "failed", "expired", "cancelled"]:
+            time.sleep(self.poll_interval)
+            batch = client.batches.retrieve(batch.id)
+        if batch.output_file_id is None:
+            raise RuntimeError("Batch {} finished with status:{}".format(batch.id, batch.status))
+        client.files.content(batch.output_file_id).write_to_file(output_path)
+
+    def run(self, prompts, stage):
+        """prompts: {custom_id: prompt_text}, returns {custom_id: response_text}"""
+        results = {}
+        requests = []
+        cache_keys = {}
+        for custom_id, prompt_text in prompts.items():
+            messages = self.llm.get_messages(prompt_text)
+            cache_keys[custom_id] = self.llm.get_cache_key(messages)
+            cached = self.llm.cache.get(cache_keys[custom_id])
+            if cached is not None:
+                results[custom_id] = cached
+            else:
+                requests.append((custom_id, self.llm.get_request_body(messages)))
+
+        # the trajectories of a user next to each other and in order, so the engine's prefix cache still holds
+        # the instructions and the user's memory (while it has not changed) when the next one is scheduled
+        requests.sort(key=lambda r: custom_id_order(r[0]))
+
+        print("Batch stage:{} prompts:{} cached:{} submitted:{}".format(stage, len(prompts), len(results), len(requests)))
+        if len(requests) > 0:
+            input_path = os.path.join(self.work_dir, "{}_input.jsonl".format(stage))
+            output_path = os.path.join(self.work_dir, "{}_output.jsonl".format(stage))
+            write_batch_file(input_path, requests)
+            if self.backend == "vllm":
+                self.submit_vllm(input_path, output_path)
+            else:
+                self.submit_openai(input_path, output_path)
+
+            for custom_id, text in iter_batch_results(output_path):
+                if text is None or custom_id not in prompts:
+                    continue
+                results[custom_id] = text
+                self.llm.cache.put(cache_keys[custom_id], text)
+
+        for custom_id in prompts:
+            if custom_id not in results:
+                results[custom_id] = self.llm.get_response(prompts[custom_id])
+        return results
@@ -0,0 +1,60 @@
+"""
+Timing benchmark of the SocialWorld graph build on a synthetic city.
+
+python -m models.benchmark_social_graph --users=20000 --venues=50000 --max_stays=40
+"""
+import time
+import random
+import argparse
+import tempfile
+
+from models.world_model import SocialWorld
+
+
+HOURS = ["{} AM".format(h) for h in range(12)] + ["12 PM"] + ["{} PM".format(h) for h in range(1, 12)]
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+
+class SyntheticDataset:
+    """Same iter_users interface as processing.data.Dataset, one trajectory per user"""
+    def __init__(self, users, venues, max_stays, seed=1234):
+        rng = random.Random(seed)
+        self.users = {}
+        for user_id in range(users):
+            stays = []
+            for _ in range(rng.randint(2, max_stays)):
+                venue = rng.randrange(venues)
+                stays.append([rng.choice(HOURS), rng.choice(DAYS), "category_{}".format(venue % 300), "venue_{}".format(venue),
+                              "admin_{}".format(venue % 10), "subdistrict_{}".format(venue % 100), "poi_{}".format(venue), "street_{}".format(venue % 2000)])
+            self.users[str(user_id)] = {"0": {"historical_stays_long": stays}}
+
+    def iter_users(self):
+        return iter(self.users.items())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--venues", type=int, default=50000)
+    parser.add_argument("--max_stays", type=int, default=40)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    dataset = SyntheticDataset(args.users, args.venues, args.max_stays)
+    print("users:{} stays:{}".format(args.users, sum(len(v["0"]["historical_stays_long"]) for v in dataset.users.values())))
+
+    for _ in range(args.repeat):
+        with tempfile.TemporaryDirectory() as save_dir:
+            start = time.perf_counter()
+            train_instances = SocialWorld.get_train_instances(dataset)
+            collected = time.perf_counter()
+            # an empty save_dir, so the graph and the transition index are built and saved
+            social_world = SocialWorld.from_stays(train_instances, save_dir, "bench")
+            done = time.perf_counter()
+
+        print("venues:{} edges:{} collect:{:.2f}s build:{:.2f}s total:{:.2f}s".format(
+            len(social_world.graph), len(social_world.graph.indices), collected - start, done - collected, done - start))
+
+
+if __name__ == "__main__":
+    main()
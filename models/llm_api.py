@@ -1,17 +1,31 @@
 
 import os
+import time
 import random
 import httpx
+import asyncio
 import argparse
-from openai import OpenAI
+import threading
+import weakref
+from openai import OpenAI, AsyncOpenAI, RateLimitError
+from openai.types import CompletionUsage
 
 from tenacity import (
     retry,
     stop_after_attempt,
     wait_random_exponential,
 )
-from config import PROXY, ATTEMPT_COUNTER, WAIT_TIME_MIN, WAIT_TIME_MAX, VLLM_URL
-from utils import token_count
+from config import PROXY, ATTEMPT_COUNTER, WAIT_TIME_MIN, WAIT_TIME_MAX, VLLM_URL, LLM_POOL_SIZES, LLM_POOL_DEFAULT_SIZE, LLM_HTTP2, LLM_ROUTES
+from .llm_cache import LLMCache, get_llm_cache
+from .token_budget import TokenMetrics
+from .rate_limiter import get_rate_limiter, get_retry_after
+from .llm_router import LLMRouter, Deployment
+from utils import PredictionStreamDetector, token_count
+
+try:
+    import h2  # HTTP/2 support of httpx
+except ImportError:
+    h2 = None
 
 
 def get_api_key(platform, model_name=None):
@@ -29,6 +43,69 @@ def get_api_key(platform, model_name=None):
         return os.environ["TOGETHER_API_KEY"]
 
 
+def get_http_limits(platform):
+    size = LLM_POOL_SIZES.get(platform, LLM_POOL_DEFAULT_SIZE)
+    return httpx.Limits(max_connections=size, max_keepalive_connections=size)
+
+
+class LLMClientRegistry:
+    """
+    Process-wide OpenAI clients keyed by (platform, model).
+
+    Clients of one platform share a single keep-alive httpx connection pool, sized per platform by
+    LLM_POOL_SIZES, and use HTTP/2 when LLM_HTTP2 is set and the h2 package is installed. Async clients
+    are bound to the event loop they are used on, so there is one async pool per platform and loop.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.http2 = LLM_HTTP2 and h2 is not None
+        self.http_clients = {}
+        self.clients = {}
+        self.async_http_clients = weakref.WeakKeyDictionary()
+        self.async_clients = weakref.WeakKeyDictionary()
+
+    def get_client(self, platform, model_name, client_kwargs):
+        with self.lock:
+            if platform not in self.http_clients:
+                self.http_clients[platform] = httpx.Client(limits=get_http_limits(platform), http2=self.http2)
+            if (platform, model_name) not in self.clients:
+                # 429s reach the caller's rate limiter instead of being retried inside the client
+                self.clients[(platform, model_name)] = OpenAI(http_client=self.http_clients[platform], max_retries=0, **client_kwargs)
+            return self.clients[(platform, model_name)]
+
+    def get_async_client(self, platform, model_name, client_kwargs):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        with self.lock:
+            # clients asked for outside a running loop are kept under the registry itself
+            owner = loop if loop is not None else self
+            http_clients = self.async_http_clients.setdefault(owner, {})
+            clients = self.async_clients.setdefault(owner, {})
+            if platform not in http_clients:
+                http_clients[platform] = httpx.AsyncClient(limits=get_http_limits(platform), http2=self.http2)
+            if (platform, model_name) not in clients:
+                clients[(platform, model_name)] = AsyncOpenAI(http_client=http_clients[platform], max_retries=0, **client_kwargs)
+            return clients[(platform, model_name)]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "platforms": sorted(self.http_clients),
+                "clients": len(self.clients),
+                "event_loops": len(self.async_clients),
+                "http2": self.http2,
+            }
+
+
+_CLIENT_REGISTRY = LLMClientRegistry()
+
+
+def get_client_registry():
+    return _CLIENT_REGISTRY
+
+
 class LLMAPI:
     def __init__(self, model_name, platform=None):
         self.model_name = model_name
@@ -41,8 +118,8 @@ class LLMAPI:
             "SiliconFlow":  [],
             "OpenAI":       [],
             "OpenRouter":   [],
-            "DeepInfra":    [],
-            "vllm":         [],
+            "DeepInfra":    ["llama3.3-70b-deepinfra"],
+            "vllm":         ["llama3.3-70b-vllm"],
             "TogetherAI":   [ 'llama3.3-70b-together', 'Qwen 2.5 72B Instruct Turbo', 'DeepSeek-V3.1', 'Llama 3.1 8B Instruct Turbo','DeepSeek-R1-0528','GPT-OSS 20B']  # ä½ å¯ä»¥æŒ‰éœ€å¢žåˆ 
         }
 
@@ -53,7 +130,9 @@ class LLMAPI:
                 'DeepSeek-V3.1': 'deepseek-ai/DeepSeek-V3.1',
                 'Llama 3.1 8B Instruct Turbo': 'meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo',
                 'DeepSeek-R1-0528': 'deepseek-ai/DeepSeek-R1',
-                'GPT-OSS 20B': 'openai/gpt-oss-20b'
+                'GPT-OSS 20B': 'openai/gpt-oss-20b',
+                'llama3.3-70b-deepinfra': 'meta-llama/Llama-3.3-70B-Instruct-Turbo',
+                'llama3.3-70b-vllm': 'meta-llama/Llama-3.3-70B-Instruct',
                 
         }
         # Decide platform
@@ -80,42 +159,29 @@ class LLMAPI:
             )
 
         # === 5) client åˆå§‹åŒ–å¢žåŠ  TogetherAI ===
+        # clients and their connection pools are shared by every LLMAPI of the process
+        self.client_kwargs = self.get_client_kwargs(model_name)
+        self.client = get_client_registry().get_client(self.platform, self.model_name, self.client_kwargs)
+
+    def get_client_kwargs(self, model_name=None):
         if self.platform == "OpenAI":
-            self.client = OpenAI(
-                api_key=get_api_key(platform),
-                http_client=httpx.Client(),
-            )
-        if self.platform == "OpenRouter":
-            self.client = OpenAI(
-                base_url="https://openrouter.ai/api/v1",
-                api_key=get_api_key(platform),
-                http_client=httpx.Client(),
-            )
+            return {"api_key": get_api_key(self.platform)}
+        elif self.platform == "OpenRouter":
+            return {"base_url": "https://openrouter.ai/api/v1", "api_key": get_api_key(self.platform)}
         elif self.platform == "DeepInfra":
-            self.client = OpenAI(
-                base_url="https://api.deepinfra.com/v1/openai",
-                api_key=get_api_key(platform),
-                http_client=httpx.Client(),
-            )
+            return {"base_url": "https://api.deepinfra.com/v1/openai", "api_key": get_api_key(self.platform)}
         elif self.platform == "SiliconFlow":
-            self.client = OpenAI(
-                base_url="https://api.siliconflow.cn/v1",
-                api_key=get_api_key(platform, model_name)
-            )
+            return {"base_url": "https://api.siliconflow.cn/v1", "api_key": get_api_key(self.platform, model_name)}
         elif self.platform == 'vllm':
-            self.client = OpenAI(
-                base_url=VLLM_URL,
-                api_key=get_api_key(platform)
-            )
+            return {"base_url": VLLM_URL, "api_key": get_api_key(self.platform)}
         elif self.platform == "TogetherAI":
-            self.client = OpenAI(
-                base_url="https://api.together.xyz/v1",
-                api_key=get_api_key(platform),
-                http_client=httpx.Client(),
-            )
+            return {"base_url": "https://api.together.xyz/v1", "api_key": get_api_key(self.platform)}
     
     def get_client(self):
         return self.client
+
+    def get_async_client(self):
+        return get_client_registry().get_async_client(self.platform, self.model_name, self.client_kwargs)
     
     def get_model_name(self):
         return self.model_mapper[self.model_name]
@@ -127,8 +193,61 @@ class LLMAPI:
         return self.model_platforms
 
 
+ROUTER_PLATFORM = "router"
+
+
+def get_route_model(model_name, platform):
+    """model of the route of a logical model that is served on platform"""
+    for route in LLM_ROUTES[model_name]:
+        if route["platform"] == platform:
+            return route["model"]
+    platforms = [route["platform"] for route in LLM_ROUTES[model_name]]
+    raise ValueError(f"Invalid API platform:{platform} for model:{model_name}, please use one of {platforms} or {ROUTER_PLATFORM}")
+
+
+def get_route_deployments(model_name):
+    """deployments of a logical model of LLM_ROUTES, skipping platforms without an API key in the environment"""
+    deployments = []
+    for route in LLM_ROUTES[model_name]:
+        try:
+            llm_api = LLMAPI(route["model"], platform=route["platform"])
+        except KeyError as e:
+            print("LLM route {}: skip {} without {}".format(model_name, route["platform"], e))
+            continue
+        rate_limiter = get_rate_limiter(route["platform"], route["model"])
+        deployments.append(Deployment(llm_api, rate_limiter, route.get("price_in", 0.0), route.get("price_out", 0.0)))
+    return deployments
+
+
+class StreamMetrics:
+    """time to first token and to a complete prediction of streamed responses"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.streams = 0
+        self.stopped_early = 0
+        self.first_token_s = 0.0
+        self.prediction_s = 0.0
+
+    def record(self, first_token_s, prediction_s):
+        with self.lock:
+            self.streams += 1
+            self.first_token_s += first_token_s or 0.0
+            if prediction_s is not None:
+                self.stopped_early += 1
+                self.prediction_s += prediction_s
+
+    def stats(self):
+        with self.lock:
+            return {
+                "streams": self.streams,
+                "stopped_early": self.stopped_early,
+                "time_to_first_token_ms": round(self.first_token_s * 1000 / self.streams, 1) if self.streams else None,
+                "time_to_prediction_ms": round(self.prediction_s * 1000 / self.stopped_early, 1) if self.stopped_early else None,
+            }
+
+
 class LLMWrapper:
-    def __init__(self, model_name, platform=None):
+    def __init__(self, model_name, platform=None, cache_mode=None, stream=False):
         self.model_name = model_name
         self.hyperparams = {
             'temperature': 0.,  # make the LLM basically deterministic
@@ -138,30 +257,207 @@ class LLMWrapper:
             'max_input_tokens': 2000 # The maximum number of input tokens
         }
         
-        self.llm_api = LLMAPI(self.model_name, platform=platform)
+        # with platform None or ROUTER_PLATFORM a logical model of LLM_ROUTES is spread over several providers,
+        # its primary deployment stands in for the single platform (cache keys, batch inference); responses of the
+        # same weights are interchangeable. Any other platform pins the deployment of the route on that platform.
+        self.router = None
+        if self.model_name in LLM_ROUTES and platform in (None, ROUTER_PLATFORM):
+            self.router = LLMRouter(self.model_name, get_route_deployments(self.model_name))
+            self.llm_api = self.router.deployments[0].llm_api
+        elif self.model_name in LLM_ROUTES:
+            self.llm_api = LLMAPI(get_route_model(self.model_name, platform), platform=platform)
+        else:
+            self.llm_api = LLMAPI(self.model_name, platform=platform)
         self.client = self.llm_api.get_client()
         self.api_model_name = self.llm_api.get_model_name()
+        # responses are memoized on disk, cache_mode=None uses LLM_CACHE_MODE from config
+        self.cache = get_llm_cache(cache_mode)
+        # prompt truncation to max_input_tokens and the token usage reported by the API
+        self.token_metrics = TokenMetrics()
+        # requests and tokens per minute of this (platform, model), shared by every thread and Agent of the process
+        self.rate_limiter = get_rate_limiter(self.llm_api.get_platform_name(), self.llm_api.model_name)
+        # stream=True reads responses incrementally and stops once the prediction JSON is complete
+        self.stream = stream
+        self.stream_metrics = StreamMetrics()
 
-    @retry(wait=wait_random_exponential(min=WAIT_TIME_MIN, max=WAIT_TIME_MAX), stop=stop_after_attempt(ATTEMPT_COUNTER))
-    def get_response(self, prompt_text):
+    @property
+    def async_client(self):
+        # looked up on every use, an async client only works on the event loop it was created on
+        return self.llm_api.get_async_client()
+
+    def get_messages(self, prompt_text):
         if "gpt" in self.model_name:
             system_messages = [{"role": "system", "content": "You are a helpful assistant who predicts user next location."}]
         else:
             system_messages = []
         
 
-        if token_count(prompt_text)>self.hyperparams['max_input_tokens']:
-            prompt_text = prompt_text[-min(self.hyperparams['max_input_tokens']*3, len(prompt_text)):]
-        
-        response = self.client.chat.completions.create(
-            model=self.api_model_name,
-            messages=system_messages + [{"role": "user", "content": prompt_text}],
-            max_tokens=self.hyperparams["max_tokens"],
-            temperature=self.hyperparams["temperature"]
-        )
-        full_text = response.choices[0].message.content
+        prompt_text = self.token_metrics.budget(prompt_text, self.hyperparams['max_input_tokens'])
+        return system_messages + [{"role": "user", "content": prompt_text}]
+
+    def get_request_body(self, messages, api_model_name=None):
+        # shared by the online requests and the offline batch files of models/batch_inference.py
+        return {
+            "model": api_model_name or self.api_model_name,
+            "messages": messages,
+            "max_tokens": self.hyperparams["max_tokens"],
+            "temperature": self.hyperparams["temperature"],
+        }
+
+    def get_cache_key(self, messages):
+        # a stream stops at the prediction JSON, its text must not be served to runs that read full responses;
+        # non-streamed keys are unchanged so existing cache entries stay valid
+        hyperparams = dict(self.hyperparams, stream=True) if self.stream else self.hyperparams
+        return LLMCache.make_key(self.llm_api.get_platform_name(), self.api_model_name, hyperparams, messages)
+
+    def get_response(self, prompt_text):
+        messages = self.get_messages(prompt_text)
+        cache_key = self.get_cache_key(messages)
+        full_text = self.cache.get(cache_key)
+        if full_text is None:
+            full_text = self.request(messages)
+            self.cache.put(cache_key, full_text)
+        return full_text
+
+    async def aget_response(self, prompt_text):
+        """Async twin of get_response, used by the concurrent prediction engine in agent.py."""
+        messages = self.get_messages(prompt_text)
+        cache_key = self.get_cache_key(messages)
+        # SQLite reads and writes block, keep them off the event loop
+        full_text = await asyncio.to_thread(self.cache.get, cache_key)
+        if full_text is None:
+            full_text = await self.arequest(messages)
+            await asyncio.to_thread(self.cache.put, cache_key, full_text)
         return full_text
 
+    @staticmethod
+    def estimate_tokens(messages):
+        return sum((len(m["content"]) + 3) // 4 for m in messages)
+
+    def record_response(self, rate_limiter, usage, estimated_tokens):
+        rate_limiter.on_success()
+        if usage is not None:
+            rate_limiter.adjust_tokens(usage.total_tokens - estimated_tokens)
+        self.token_metrics.record_usage(usage)
+
+    @staticmethod
+    def chunk_text(chunk):
+        if not chunk.choices:
+            return "", ""
+        delta = chunk.choices[0].delta
+        return delta.content or "", getattr(delta, "reasoning_content", None) or ""
+
+    @staticmethod
+    def chunk_usage(chunk):
+        # openai==1.25 has no usage field on chunks, the extra field comes back as a plain dict
+        usage = getattr(chunk, "usage", None)
+        if isinstance(usage, dict):
+            usage = CompletionUsage(**usage)
+        return usage
+
+    @staticmethod
+    def estimate_usage(messages, completion_text):
+        """usage of a stream stopped before the final usage chunk, counted from the text sent and received"""
+        prompt_tokens = sum(token_count(m["content"]) for m in messages)
+        completion_tokens = token_count(completion_text) if completion_text else 0
+        return CompletionUsage(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens)
+
+    def stream_completion(self, client, body):
+        start = time.perf_counter()
+        first_token_s, prediction_s = None, None
+        detector = PredictionStreamDetector()
+        # the provider reports the usage in a last chunk, which a stream stopped early never reads; passed as
+        # extra_body since the pinned openai client has no stream_options argument
+        stream = client.chat.completions.create(**body, stream=True, extra_body={"stream_options": {"include_usage": True}})
+        usage, reasoning_text = None, []
+        try:
+            for chunk in stream:
+                usage = self.chunk_usage(chunk) or usage
+                content, reasoning = self.chunk_text(chunk)
+                reasoning_text.append(reasoning)
+                if first_token_s is None and (content or reasoning):
+                    first_token_s = time.perf_counter() - start
+                if detector.feed(content):
+                    prediction_s = time.perf_counter() - start
+                    break
+        finally:
+            stream.close()
+        self.stream_metrics.record(first_token_s, prediction_s)
+        full_text = "".join(detector.text)
+        if usage is None:
+            usage = self.estimate_usage(body["messages"], "".join(reasoning_text) + full_text)
+        return full_text, usage
+
+    async def astream_completion(self, client, body):
+        start = time.perf_counter()
+        first_token_s, prediction_s = None, None
+        detector = PredictionStreamDetector()
+        # the provider reports the usage in a last chunk, which a stream stopped early never reads; passed as
+        # extra_body since the pinned openai client has no stream_options argument
+        stream = await client.chat.completions.create(**body, stream=True, extra_body={"stream_options": {"include_usage": True}})
+        usage, reasoning_text = None, []
+        try:
+            async for chunk in stream:
+                usage = self.chunk_usage(chunk) or usage
+                content, reasoning = self.chunk_text(chunk)
+                reasoning_text.append(reasoning)
+                if first_token_s is None and (content or reasoning):
+                    first_token_s = time.perf_counter() - start
+                if detector.feed(content):
+                    prediction_s = time.perf_counter() - start
+                    break
+        finally:
+            await stream.close()
+        self.stream_metrics.record(first_token_s, prediction_s)
+        full_text = "".join(detector.text)
+        if usage is None:
+            usage = self.estimate_usage(body["messages"], "".join(reasoning_text) + full_text)
+        return full_text, usage
+
+    def complete(self, llm_api, rate_limiter, messages):
+        """one request to one (platform, model), returns (text, usage)"""
+        body = self.get_request_body(messages, llm_api.get_model_name())
+        estimated_tokens = self.estimate_tokens(messages)
+        with rate_limiter.limit(estimated_tokens):
+            try:
+                if self.stream:
+                    full_text, usage = self.stream_completion(llm_api.get_client(), body)
+                else:
+                    response = llm_api.get_client().chat.completions.create(**body)
+                    full_text, usage = response.choices[0].message.content, response.usage
+            except RateLimitError as e:
+                rate_limiter.on_rate_limited(get_retry_after(e))
+                raise
+        self.record_response(rate_limiter, usage, estimated_tokens)
+        return full_text, usage
+
+    async def acomplete(self, llm_api, rate_limiter, messages):
+        body = self.get_request_body(messages, llm_api.get_model_name())
+        estimated_tokens = self.estimate_tokens(messages)
+        async with rate_limiter.alimit(estimated_tokens):
+            try:
+                if self.stream:
+                    full_text, usage = await self.astream_completion(llm_api.get_async_client(), body)
+                else:
+                    response = await llm_api.get_async_client().chat.completions.create(**body)
+                    full_text, usage = response.choices[0].message.content, response.usage
+            except RateLimitError as e:
+                rate_limiter.on_rate_limited(get_retry_after(e))
+                raise
+        self.record_response(rate_limiter, usage, estimated_tokens)
+        return full_text, usage
+
+    @retry(wait=wait_random_exponential(min=WAIT_TIME_MIN, max=WAIT_TIME_MAX), stop=stop_after_attempt(ATTEMPT_COUNTER))
+    def request(self, messages):
+        if self.router is not None:
+            return self.router.complete(lambda d: self.complete(d.llm_api, d.rate_limiter, messages))
+        return self.complete(self.llm_api, self.rate_limiter, messages)[0]
+
+    @retry(wait=wait_random_exponential(min=WAIT_TIME_MIN, max=WAIT_TIME_MAX), stop=stop_after_attempt(ATTEMPT_COUNTER))
+    async def arequest(self, messages):
+        if self.router is not None:
+            return await self.router.acomplete(lambda d: self.acomplete(d.llm_api, d.rate_limiter, messages))
+        return (await self.acomplete(self.llm_api, self.rate_limiter, messages))[0]
 
 if __name__ == "__main__":
     prompt_text = "Who are you?"
@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import atexit
+import sqlite3
+import hashlib
+import threading
+
+from config import LLM_CACHE_PATH, LLM_CACHE_MODE, LLM_CACHE_MAX_SIZE_MB, LLM_CACHE_MAX_AGE_DAYS
+
+
+CACHE_MODES = ["off", "read_write", "read_only"]
+
+
+class LLMCache:
+    """
+    Disk-backed (SQLite) cache of LLM responses.
+
+    Entries are keyed by a hash of (platform, api_model_name, hyperparams, messages); with temperature 0
+    a rerun of the same experiment is then served from disk. Entries older than max_age_days, and the
+    least recently used entries beyond max_size_mb, are evicted. In "read_only" mode nothing is written
+    or evicted, which keeps benchmark reruns reproducible. Access times of hits are kept in memory and
+    written in one transaction every access_flush_s seconds (or access_flush_size hits) and before eviction.
+    """
+    def __init__(self, path=LLM_CACHE_PATH, mode=LLM_CACHE_MODE, max_size_mb=LLM_CACHE_MAX_SIZE_MB,
+                 max_age_days=LLM_CACHE_MAX_AGE_DAYS, evict_every=200, access_flush_s=30.0, access_flush_size=1000):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Invalid LLM cache mode:{mode}, please use one of {CACHE_MODES}")
+        self.path = path
+        self.mode = mode
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.max_age_s = max_age_days * 24 * 3600
+        self.evict_every = evict_every
+        self.access_flush_s = access_flush_s
+        self.access_flush_size = access_flush_size
+        self.pending_access = {}
+        self.flushed_at = time.monotonic()
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.lock = threading.Lock()
+        self.conn = None
+
+        if self.mode == "read_write":
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_accessed_at ON responses (accessed_at)")
+            self.conn.commit()
+            self.evict()
+            atexit.register(self.flush)
+        elif self.mode == "read_only" and os.path.exists(self.path):
+            self.conn = sqlite3.connect(f"file:{os.path.abspath(self.path)}?mode=ro", uri=True, check_same_thread=False)
+
+    @staticmethod
+    def make_key(platform, api_model_name, hyperparams, messages):
+        payload = json.dumps(
+            {"platform": platform, "model": api_model_name, "hyperparams": hyperparams, "messages": messages},
+            sort_keys=True, ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        if self.conn is None:
+            if self.mode != "off":
+                self.misses += 1
+            return None
+        with self.lock:
+            row = self.conn.execute("SELECT response, created_at FROM responses WHERE key=?", (key,)).fetchone()
+            if row is not None and self.max_age_s > 0 and time.time() - row[1] > self.max_age_s:
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if self.mode == "read_write":
+                self.pending_access[key] = time.time()
+                if len(self.pending_access) >= self.access_flush_size or time.monotonic() - self.flushed_at >= self.access_flush_s:
+                    self._flush_access()
+        return row[0]
+
+    def _flush_access(self):
+        # caller holds self.lock
+        if self.pending_access:
+            self.conn.executemany("UPDATE responses SET accessed_at=? WHERE key=?", [(t, k) for k, t in self.pending_access.items()])
+            self.conn.commit()
+            self.pending_access = {}
+        self.flushed_at = time.monotonic()
+
+    def flush(self):
+        if self.mode != "read_write":
+            return
+        with self.lock:
+            self._flush_access()
+
+    def put(self, key, response):
+        if self.mode != "read_write" or not isinstance(response, str) or len(response) == 0:
+            return
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, response, len(response.encode("utf-8")), now, now),
+            )
+            self.conn.commit()
+            self.writes += 1
+        if self.writes % self.evict_every == 0:
+            self.evict()
+
+    def evict(self):
+        if self.mode != "read_write":
+            return
+        with self.lock:
+            # least recently used order needs the access times of recent hits
+            self._flush_access()
+            if self.max_age_s > 0:
+                self.conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age_s,))
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if self.max_size_bytes > 0 and total > self.max_size_bytes:
+                # least recently used first
+                stale_keys = []
+                for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY accessed_at ASC"):
+                    if total <= self.max_size_bytes:
+                        break
+                    stale_keys.append((key,))
+                    total -= size
+                self.conn.executemany("DELETE FROM responses WHERE key=?", stale_keys)
+            self.conn.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "mode": self.mode,
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+# one cache per (path, mode) per process, shared by all LLMWrapper instances
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+
+def get_llm_cache(mode=None, path=LLM_CACHE_PATH):
+    mode = LLM_CACHE_MODE if mode is None else mode
+    with _CACHES_LOCK:
+        if (path, mode) not in _CACHES:
+            _CACHES[(path, mode)] = LLMCache(path=path, mode=mode)
+        return _CACHES[(path, mode)]
@@ -0,0 +1,234 @@
+import time
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from config import LLM_HEDGE_PERCENTILE, LLM_HEDGE_MIN_SAMPLES, LLM_HEDGE_DEFAULT_DELAY_S, LLM_FAILOVER_COOLDOWN_S, LLM_ROUTE_LATENCY_SLACK
+
+
+class Deployment:
+    """one provider deployment of a logical model: its LLMAPI, rate limiter, recent latencies and spend"""
+    def __init__(self, llm_api, rate_limiter, price_in=0.0, price_out=0.0, latency_window=500):
+        self.llm_api = llm_api
+        self.rate_limiter = rate_limiter
+        self.name = "{}:{}".format(llm_api.get_platform_name(), llm_api.model_name)
+        # USD per 1M prompt / completion tokens
+        self.price_in = price_in
+        self.price_out = price_out
+
+        self.lock = threading.Lock()
+        self.latency_s = deque(maxlen=latency_window)
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.wins = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost_usd = 0.0
+
+    def percentile(self, q):
+        with self.lock:
+            samples = sorted(self.latency_s)
+        if not samples:
+            return None
+        return samples[min(int(len(samples) * q / 100), len(samples) - 1)]
+
+    def cooling(self, now):
+        return self.cooldown_until > now
+
+    def record_success(self, latency_s, usage):
+        with self.lock:
+            self.requests += 1
+            self.latency_s.append(latency_s)
+            if usage is not None:
+                prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+                completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+                self.prompt_tokens += prompt_tokens
+                self.completion_tokens += completion_tokens
+                self.cost_usd += (prompt_tokens * self.price_in + completion_tokens * self.price_out) / 1e6
+
+    def record_error(self, cooldown_s):
+        with self.lock:
+            self.requests += 1
+            self.errors += 1
+            self.cooldown_until = max(self.cooldown_until, time.monotonic() + cooldown_s)
+
+    def stats(self):
+        p50, p99 = self.percentile(50), self.percentile(99)
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "wins": self.wins,
+                "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+                "p99_ms": round(p99 * 1000, 1) if p99 is not None else None,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "cost_usd": round(self.cost_usd, 4),
+            }
+
+
+class LLMRouter:
+    """
+    Spreads the requests of one logical model (LLM_ROUTES) over several provider deployments.
+
+    Deployments are ranked by recent median latency; one that failed is moved to the back for cooldown_s.
+    Among deployments within latency_slack of the fastest, the cheapest goes first, and deployments without
+    latency samples keep the configured order. A request goes to the first deployment; the next one gets a
+    hedged duplicate when no answer arrived within the hedge_percentile latency of the first, and is asked
+    right away when the previous one failed. The first successful answer wins.
+    """
+    def __init__(self, model_name, deployments, hedge_percentile=LLM_HEDGE_PERCENTILE, hedge_min_samples=LLM_HEDGE_MIN_SAMPLES,
+                 hedge_default_delay_s=LLM_HEDGE_DEFAULT_DELAY_S, cooldown_s=LLM_FAILOVER_COOLDOWN_S,
+                 latency_slack=LLM_ROUTE_LATENCY_SLACK, max_workers=64):
+        if not deployments:
+            raise ValueError("No deployment available for model {}".format(model_name))
+        self.model_name = model_name
+        self.deployments = list(deployments)
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_default_delay_s = hedge_default_delay_s
+        self.cooldown_s = cooldown_s
+        self.latency_slack = latency_slack
+        # sync requests run on worker threads, so a hedged duplicate can be sent while the first one is waiting
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm-router")
+
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.hedged = 0
+        self.failovers = 0
+
+    def ranked(self):
+        now = time.monotonic()
+
+        def key(d):
+            p50 = d.percentile(50)
+            return d.cooling(now), p50 if p50 is not None else float("inf")
+
+        ranked = sorted(self.deployments, key=key)
+        best = key(ranked[0])
+        if best[1] != float("inf"):
+            close = [d for d in ranked if key(d)[0] == best[0] and key(d)[1] <= best[1] * (1 + self.latency_slack)]
+            cheapest = min(close, key=lambda d: d.price_in + d.price_out)
+            ranked.remove(cheapest)
+            ranked.insert(0, cheapest)
+        return ranked
+
+    def hedge_delay(self, deployment):
+        with deployment.lock:
+            num_samples = len(deployment.latency_s)
+        if num_samples < self.hedge_min_samples:
+            return self.hedge_default_delay_s
+        return deployment.percentile(self.hedge_percentile)
+
+    def timed(self, deployment, call):
+        start = time.perf_counter()
+        try:
+            full_text, usage = call(deployment)
+        except Exception:
+            deployment.record_error(self.cooldown_s)
+            raise
+        deployment.record_success(time.perf_counter() - start, usage)
+        return full_text
+
+    async def atimed(self, deployment, acall):
+        start = time.perf_counter()
+        try:
+            full_text, usage = await acall(deployment)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            deployment.record_error(self.cooldown_s)
+            raise
+        deployment.record_success(time.perf_counter() - start, usage)
+        return full_text
+
+    def record_request(self, winner, launched, failed):
+        with winner.lock:
+            winner.wins += 1
+        with self.lock:
+            self.requests += 1
+            self.hedged += launched - 1 > failed
+            self.failovers += failed > 0
+
+    def complete(self, call):
+        """call(deployment) sends one request and returns (text, usage); returns the text of the first success"""
+        ranked = self.ranked()
+        futures = {}
+        failed = 0
+        last_exc = None
+
+        def launch():
+            deployment = ranked[len(futures)]
+            futures[self.executor.submit(self.timed, deployment, call)] = deployment
+
+        launch()
+        pending = set(futures)
+        # futures already looked at, one that finished while the next deployment was launched stays pending
+        handled = set()
+        while pending:
+            can_hedge = len(futures) < len(ranked)
+            done, pending = wait(pending, timeout=self.hedge_delay(ranked[0]) if can_hedge else None, return_when=FIRST_COMPLETED)
+            handled |= done
+            for future in done:
+                if future.exception() is None:
+                    # a request already sent cannot be taken back, a slower duplicate finishes on its thread
+                    for other in pending:
+                        other.cancel()
+                    self.record_request(futures[future], len(futures), failed)
+                    return future.result()
+                failed += 1
+                last_exc = future.exception()
+            if can_hedge:
+                # slow or failed so far, ask the next deployment too
+                launch()
+                pending = set(futures) - handled
+        with self.lock:
+            self.requests += 1
+        raise last_exc
+
+    async def acomplete(self, acall):
+        """async twin of complete, losing requests are cancelled"""
+        ranked = self.ranked()
+        tasks = {}
+        failed = 0
+        last_exc = None
+
+        def launch():
+            deployment = ranked[len(tasks)]
+            tasks[asyncio.create_task(self.atimed(deployment, acall))] = deployment
+
+        launch()
+        pending = set(tasks)
+        handled = set()
+        try:
+            while pending:
+                can_hedge = len(tasks) < len(ranked)
+                done, pending = await asyncio.wait(
+                    pending, timeout=self.hedge_delay(ranked[0]) if can_hedge else None, return_when=asyncio.FIRST_COMPLETED
+                )
+                handled |= done
+                for task in done:
+                    if task.exception() is None:
+                        self.record_request(tasks[task], len(tasks), failed)
+                        return task.result()
+                    failed += 1
+                    last_exc = task.exception()
+                if can_hedge:
+                    launch()
+                    pending = set(tasks) - handled
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        with self.lock:
+            self.requests += 1
+        raise last_exc
+
+    def stats(self):
+        with self.lock:
+            stats = {"requests": self.requests, "hedged": self.hedged, "failovers": self.failovers}
+        stats["deployments"] = {d.name: d.stats() for d in self.deployments}
+        stats["cost_usd"] = round(sum(d.cost_usd for d in self.deployments), 4)
+        return stats
@@ -0,0 +1,10 @@
+import os
+
+import numpy as np
+
+
+def save_npz_atomic(path, **arrays):
+    # write then rename, a crash never leaves a half written file
+    with open(path + ".tmp", "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(path + ".tmp", path)
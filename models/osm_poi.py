@@ -2,7 +2,10 @@ from __future__ import annotations
 
 import time
 import random
+import asyncio
 import requests
+import httpx
+from collections import Counter, deque
 from dataclasses import dataclass
 from typing import Dict, Any, List, Optional, Iterable, Tuple
 
@@ -15,6 +18,8 @@ OVERPASS_ENDPOINTS = [
 
 RETRY_STATUS = {429, 502, 503, 504}
 
+DEFAULT_POI_KEYS = ["amenity", "tourism", "shop", "leisure"]
+
 
 @dataclass
 class POI:
@@ -147,7 +152,7 @@ def fetch_pois_osm_overpass(
     osm_types: Optional[List[str]] = None,  # NEW
 ) -> List[POI]:
     if poi_keys is None:
-        poi_keys = ["amenity", "tourism", "shop", "leisure"]
+        poi_keys = DEFAULT_POI_KEYS
 
     if osm_types is None:
         osm_types = ["node", "way", "relation"]
@@ -173,6 +178,171 @@ def fetch_pois_osm_overpass(
     return list(uniq.values())
 
 
+class OverpassClient:
+    """
+    Async Overpass client for the MCP server.
+
+    All queries share one httpx.AsyncClient connection pool. Per-key queries run concurrently instead of
+    one after another. Endpoints are hedged: the endpoint with the lowest recent median latency is asked
+    first, and the next one is started when no answer arrived within hedge_delay_s or the previous one
+    failed. The first successful answer wins and the others are cancelled.
+    """
+
+    def __init__(
+        self,
+        endpoints: List[str] = OVERPASS_ENDPOINTS,
+        hedge_delay_s: float = 2.0,
+        max_attempts_per_endpoint: int = 3,
+        base_backoff_s: float = 1.0,
+        timeout_http_s: int = 60,
+        max_connections: int = 16,
+        latency_window: int = 200,
+    ):
+        self.endpoints = list(endpoints)
+        self.hedge_delay_s = hedge_delay_s
+        self.max_attempts_per_endpoint = max_attempts_per_endpoint
+        self.base_backoff_s = base_backoff_s
+        self.timeout_http_s = timeout_http_s
+        self.max_connections = max_connections
+        self.latency_s = {ep: deque(maxlen=latency_window) for ep in self.endpoints}
+        self.errors: Counter = Counter()
+        self.wins: Counter = Counter()
+        self.client: Optional[httpx.AsyncClient] = None
+
+    def _client(self) -> httpx.AsyncClient:
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                timeout=self.timeout_http_s,
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+            )
+        return self.client
+
+    async def aclose(self) -> None:
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def _median_latency(self, ep: str) -> float:
+        samples = sorted(self.latency_s[ep])
+        return samples[len(samples) // 2] if samples else float("inf")
+
+    async def _post_endpoint(self, ep: str, ql: str) -> Dict[str, Any]:
+        last_exc: Optional[Exception] = None
+        for attempt in range(1, self.max_attempts_per_endpoint + 1):
+            start = time.perf_counter()
+            try:
+                resp = await self._client().post(ep, data={"data": ql})
+                if resp.status_code not in RETRY_STATUS:
+                    resp.raise_for_status()
+                    data = resp.json()
+                    self.latency_s[ep].append(time.perf_counter() - start)
+                    return data
+                last_exc = httpx.HTTPStatusError(f"Overpass returned {resp.status_code}", request=resp.request, response=resp)
+            except httpx.HTTPStatusError as e:
+                self.errors[ep] += 1
+                raise e
+            except httpx.TransportError as e:
+                last_exc = e
+            self.errors[ep] += 1
+            if attempt < self.max_attempts_per_endpoint:
+                await asyncio.sleep(self.base_backoff_s * (2 ** (attempt - 1)) + random.uniform(0, 0.5))
+        raise last_exc
+
+    async def post(self, ql: str) -> Dict[str, Any]:
+        endpoints = sorted(self.endpoints, key=self._median_latency)
+        tasks: Dict[asyncio.Task, str] = {}
+        last_exc: Optional[BaseException] = None
+
+        def launch() -> None:
+            ep = endpoints[len(tasks)]
+            tasks[asyncio.create_task(self._post_endpoint(ep, ql))] = ep
+
+        launch()
+        pending = set(tasks)
+        try:
+            while pending:
+                can_hedge = len(tasks) < len(endpoints)
+                done, pending = await asyncio.wait(
+                    pending, timeout=self.hedge_delay_s if can_hedge else None, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        self.wins[tasks[task]] += 1
+                        return task.result()
+                    last_exc = task.exception()
+                if can_hedge:
+                    # slow or failed so far, ask the next endpoint too
+                    launch()
+                    pending = {t for t in tasks if not t.done()}
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        raise RuntimeError(f"All Overpass endpoints failed. Last error: {last_exc!r}")
+
+    async def fetch_pois(
+        self,
+        lat: float,
+        lon: float,
+        radius_m: int = 500,
+        poi_keys: Optional[List[str]] = None,
+        name_query: Optional[str] = None,
+        limit: int = 200,
+        timeout_overpass_s: int = 25,
+        split_by_key: bool = False,
+        osm_types: Optional[List[str]] = None,
+    ) -> List[POI]:
+        """Async fetch_pois_osm_overpass: one union query, or all per-key queries at once when split_by_key"""
+        if poi_keys is None:
+            poi_keys = DEFAULT_POI_KEYS
+
+        if osm_types is None:
+            osm_types = ["node", "way", "relation"]
+
+        key_groups = [[k] for k in poi_keys] if split_by_key else [poi_keys]
+        results = await asyncio.gather(*[
+            self.post(_build_overpass_query(lat, lon, radius_m, keys, name_query, limit, timeout_overpass_s, osm_types))
+            for keys in key_groups
+        ])
+
+        all_elements: List[Dict[str, Any]] = []
+        for data in results:
+            all_elements.extend(data.get("elements", []) or [])
+
+        pois = _parse_elements_to_pois(all_elements, poi_keys)
+
+        uniq: Dict[Tuple[str, int], POI] = {}
+        for p in pois:
+            uniq[(p.osm_type, p.osm_id)] = p
+
+        return list(uniq.values())
+
+    def latency_stats(self) -> Dict[str, Dict[str, Any]]:
+        stats = {}
+        for ep in self.endpoints:
+            samples = sorted(self.latency_s[ep])
+            stats[ep] = {
+                "samples": len(samples),
+                "errors": self.errors[ep],
+                "wins": self.wins[ep],
+                "p50_ms": round(samples[len(samples) // 2] * 1000, 1) if samples else None,
+                "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 1) if samples else None,
+            }
+        return stats
+
+
+_OVERPASS_CLIENT: Optional[OverpassClient] = None
+
+
+def get_overpass_client() -> OverpassClient:
+    """one client, and so one connection pool, per process"""
+    global _OVERPASS_CLIENT
+    if _OVERPASS_CLIENT is None:
+        _OVERPASS_CLIENT = OverpassClient()
+    return _OVERPASS_CLIENT
+
+
 def pois_to_text(pois: List[POI], max_items: int = 80) -> str:
     """
     Turn POIs into a compact, LLM-friendly text (avoid dumping huge tags).
@@ -0,0 +1,283 @@
+"""
+Offline POI backend: a grid-bucketed spatial index built once from a local OSM extract.
+
+python -m models.osm_poi_index --source=data/osm/new-york.osm.pbf --output=data/osm/poi_index.npz
+
+The source is an Overpass style JSON file ({"elements": [...]}) or an .osm.pbf extract (requires the optional
+`osmium` package). POIs are sorted by grid cell, so a radius query reads one contiguous slice of the sorted
+cell keys per grid row and never touches the network. The bounding box of the extract is stored with the index,
+queries reaching outside of it are left to Overpass by the MCP server.
+"""
+from __future__ import annotations
+
+import os
+import re
+import json
+import argparse
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from models.osm_poi import POI, DEFAULT_POI_KEYS, _parse_elements_to_pois
+from models.npz_io import save_npz_atomic
+
+try:
+    import osmium
+except ImportError:
+    osmium = None
+
+
+DEFAULT_INDEX_PATH = "data/osm/poi_index.npz"
+INDEX_KEYS = ["amenity", "tourism", "shop", "leisure", "office", "craft", "healthcare", "historic", "public_transport", "railway", "sport"]
+OSM_TYPES = ["node", "way", "relation"]
+CELL_DEG = 0.005  # about 550m of latitude per grid cell
+NUM_COLS = int(round(360 / CELL_DEG))
+EARTH_RADIUS_M = 6371008.8
+
+
+def cell_keys(lat, lon):
+    rows = np.floor((np.asarray(lat, dtype=np.float64) + 90) / CELL_DEG).astype(np.int64)
+    cols = np.floor((np.asarray(lon, dtype=np.float64) + 180) / CELL_DEG).astype(np.int64)
+    return rows * NUM_COLS + np.clip(cols, 0, NUM_COLS - 1)
+
+
+def haversine_m(lat, lon, lats, lons):
+    lat, lon, lats, lons = np.radians(lat), np.radians(lon), np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def _load_pbf_elements(source_path: str, keys: List[str]) -> List[Dict[str, Any]]:
+    if osmium is None:
+        raise ImportError("Reading .osm.pbf extracts requires the osmium package: pip install osmium")
+    keys = set(keys)
+    elements: List[Dict[str, Any]] = []
+
+    class POIHandler(osmium.SimpleHandler):
+        def node(self, n):
+            tags = {t.k: t.v for t in n.tags}
+            if keys & tags.keys() and n.location.valid():
+                elements.append({"type": "node", "id": n.id, "lat": n.location.lat, "lon": n.location.lon, "tags": tags})
+
+        def way(self, w):
+            tags = {t.k: t.v for t in w.tags}
+            if not keys & tags.keys():
+                return
+            coords = [(nd.lat, nd.lon) for nd in w.nodes if nd.location.valid()]
+            if coords:
+                lats, lons = zip(*coords)
+                elements.append({"type": "way", "id": w.id, "center": {"lat": sum(lats) / len(lats), "lon": sum(lons) / len(lons)}, "tags": tags})
+
+    POIHandler().apply_file(source_path, locations=True)
+    return elements
+
+
+def _load_pbf_bbox(source_path: str) -> Optional[List[float]]:
+    """[min_lat, min_lon, max_lat, max_lon] from the header of a .osm.pbf extract, None when it has no bounding box"""
+    reader = osmium.io.Reader(source_path, osmium.osm.osm_entity_bits.NOTHING)
+    try:
+        box = reader.header().box()
+    finally:
+        reader.close()
+    if not box.valid():
+        return None
+    return [box.bottom_left.lat, box.bottom_left.lon, box.top_right.lat, box.top_right.lon]
+
+
+def load_osm_elements(source_path: str, keys: List[str]) -> List[Dict[str, Any]]:
+    if source_path.endswith(".pbf"):
+        return _load_pbf_elements(source_path, keys)
+    with open(source_path, encoding="utf-8") as f:
+        data = json.load(f)
+    return data.get("elements", []) or []
+
+
+class OSMPOIIndex:
+    """
+    In-memory POI arrays sorted by grid cell key, answering the get_nearby_pois contract of the MCP server.
+    Tags of every POI are kept as a JSON blob plus offsets and are only decoded for candidates inside the radius.
+    bbox is [min_lat, min_lon, max_lat, max_lon] of the extract, the extent of the POIs when not known
+    (e.g. index files written before it was stored).
+    """
+    def __init__(self, keys, lat, lon, cell, osm_type, osm_id, has_key, tag_offsets, tag_blob, bbox=None):
+        self.keys = [str(k) for k in keys]
+        self.key_index = {k: i for i, k in enumerate(self.keys)}
+        self.lat = lat
+        self.lon = lon
+        self.cell = cell
+        self.osm_type = osm_type
+        self.osm_id = osm_id
+        self.has_key = has_key
+        self.tag_offsets = tag_offsets
+        self.tag_blob = tag_blob
+        if bbox is None and len(lat):
+            bbox = [lat.min(), lon.min(), lat.max(), lon.max()]
+        self.bbox = np.asarray(bbox, dtype=np.float64) if bbox is not None else None
+
+    @classmethod
+    def from_pois(cls, pois: List[POI], keys: List[str] = INDEX_KEYS, bbox: Optional[List[float]] = None):
+        uniq = {(p.osm_type, p.osm_id): p for p in pois if any(k in p.tags for k in keys)}
+        pois = list(uniq.values())
+        lat = np.array([p.lat for p in pois], dtype=np.float64)
+        lon = np.array([p.lon for p in pois], dtype=np.float64)
+        cell = cell_keys(lat, lon)
+        order = np.argsort(cell, kind="stable")
+        pois = [pois[i] for i in order]
+
+        blobs = [json.dumps(p.tags, ensure_ascii=False).encode("utf-8") for p in pois]
+        tag_offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in blobs], out=tag_offsets[1:])
+        return cls(
+            keys=keys,
+            lat=lat[order],
+            lon=lon[order],
+            cell=cell[order],
+            osm_type=np.array([OSM_TYPES.index(p.osm_type) if p.osm_type in OSM_TYPES else 0 for p in pois], dtype=np.uint8),
+            osm_id=np.array([p.osm_id for p in pois], dtype=np.int64),
+            has_key=np.array([[k in p.tags for k in keys] for p in pois], dtype=bool).reshape(len(pois), len(keys)),
+            tag_offsets=tag_offsets,
+            tag_blob=np.frombuffer(b"".join(blobs), dtype=np.uint8),
+            bbox=bbox,
+        )
+
+    @classmethod
+    def build(cls, source_path: str, keys: List[str] = INDEX_KEYS, bbox: Optional[List[float]] = None):
+        elements = load_osm_elements(source_path, keys)
+        if bbox is None and source_path.endswith(".pbf"):
+            bbox = _load_pbf_bbox(source_path)
+        return cls.from_pois(_parse_elements_to_pois(elements, keys), keys, bbox=bbox)
+
+    @classmethod
+    def load(cls, path: str):
+        data = np.load(path)
+        return cls(**{name: data[name] for name in data.files})
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        arrays = dict(keys=np.array(self.keys, dtype=str), lat=self.lat, lon=self.lon, cell=self.cell,
+                      osm_type=self.osm_type, osm_id=self.osm_id, has_key=self.has_key,
+                      tag_offsets=self.tag_offsets, tag_blob=self.tag_blob)
+        if self.bbox is not None:
+            arrays["bbox"] = self.bbox
+        save_npz_atomic(path, **arrays)
+
+    def __len__(self):
+        return len(self.lat)
+
+    def tags(self, i: int) -> Dict[str, Any]:
+        return json.loads(self.tag_blob[self.tag_offsets[i]:self.tag_offsets[i + 1]].tobytes().decode("utf-8"))
+
+    @staticmethod
+    def _radius_deg(lat: float, radius_m: int):
+        dlat = np.degrees(radius_m / EARTH_RADIUS_M)
+        return dlat, dlat / max(np.cos(np.radians(lat)), 1e-6)
+
+    def covers(self, lat: float, lon: float, radius_m: int) -> bool:
+        """whether the whole circle of radius_m around (lat, lon) lies inside the extract"""
+        if self.bbox is None:
+            return False
+        dlat, dlon = self._radius_deg(lat, radius_m)
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        return min_lat <= lat - dlat and lat + dlat <= max_lat and min_lon <= lon - dlon and lon + dlon <= max_lon
+
+    def _candidates(self, lat: float, lon: float, radius_m: int) -> np.ndarray:
+        dlat, dlon = self._radius_deg(lat, radius_m)
+        row0, col0 = divmod(int(cell_keys(lat - dlat, lon - dlon)), NUM_COLS)
+        row1, col1 = divmod(int(cell_keys(lat + dlat, lon + dlon)), NUM_COLS)
+        row_base = np.arange(row0, row1 + 1, dtype=np.int64) * NUM_COLS
+        starts = np.searchsorted(self.cell, row_base + col0, side="left")
+        ends = np.searchsorted(self.cell, row_base + col1, side="right")
+        if not len(starts) or (ends - starts).sum() == 0:
+            return np.zeros(0, dtype=np.int64)
+        idx = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+        dist = haversine_m(lat, lon, self.lat[idx], self.lon[idx])
+        inside = dist <= radius_m
+        idx, dist = idx[inside], dist[inside]
+        return idx[np.lexsort((self.osm_id[idx], dist))]
+
+    def query(
+        self,
+        lat: float,
+        lon: float,
+        radius_m: int = 500,
+        poi_keys: Optional[List[str]] = None,
+        name_query: Optional[str] = None,
+        limit: int = 200,
+        split_by_key: bool = False,
+        osm_types: Optional[List[str]] = None,
+    ) -> List[POI]:
+        """Same filters as fetch_pois_osm_overpass; POIs come back nearest first, `limit` applies per key when split_by_key."""
+        if poi_keys is None:
+            poi_keys = DEFAULT_POI_KEYS
+        if osm_types is None:
+            osm_types = OSM_TYPES
+        name_pattern = re.compile(name_query, re.IGNORECASE) if name_query else None
+
+        idx = self._candidates(lat, lon, radius_m)
+        type_codes = [OSM_TYPES.index(t) for t in osm_types if t in OSM_TYPES] or list(range(len(OSM_TYPES)))
+        idx = idx[np.isin(self.osm_type[idx], type_codes)]
+
+        tags = {}
+
+        def matches(i, keys):
+            if i not in tags:
+                tags[i] = self.tags(i)
+            if not any(k in tags[i] for k in keys):
+                return False
+            return name_pattern is None or name_pattern.search(str(tags[i].get("name", ""))) is not None
+
+        def select(keys):
+            indexed = [self.key_index[k] for k in keys if k in self.key_index]
+            candidates = idx
+            if len(indexed) == len(keys):
+                candidates = idx[self.has_key[idx][:, indexed].any(axis=1)]
+            picked = []
+            for i in candidates.tolist():
+                if len(picked) >= limit:
+                    break
+                if matches(i, keys):
+                    picked.append(i)
+            return picked
+
+        picked = {}
+        for keys in ([[k] for k in poi_keys] if split_by_key else [poi_keys]):
+            picked.update(dict.fromkeys(select(keys)))
+
+        pois = []
+        for i in picked:
+            category, value = "", ""
+            for k in poi_keys:
+                if k in tags[i]:
+                    category, value = k, str(tags[i][k])
+                    break
+            pois.append(POI(
+                osm_type=OSM_TYPES[self.osm_type[i]],
+                osm_id=int(self.osm_id[i]),
+                lat=float(self.lat[i]),
+                lon=float(self.lon[i]),
+                name=str(tags[i].get("name", "")),
+                category=category,
+                value=value,
+                tags=tags[i],
+            ))
+        return pois
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", type=str, required=True, help="Overpass JSON ({'elements': [...]}) or .osm.pbf extract")
+    parser.add_argument("--output", type=str, default=DEFAULT_INDEX_PATH)
+    parser.add_argument("--keys", type=str, default=",".join(INDEX_KEYS), help="Comma-separated OSM keys kept in the index")
+    parser.add_argument("--bbox", type=str, default=None,
+                        help="min_lat,min_lon,max_lat,max_lon covered by the source, default the .pbf header or the extent of the POIs")
+    args = parser.parse_args()
+
+    keys = [k.strip() for k in args.keys.split(",") if k.strip()]
+    bbox = [float(x) for x in args.bbox.split(",")] if args.bbox else None
+    index = OSMPOIIndex.build(args.source, keys, bbox=bbox)
+    index.save(args.output)
+    print("indexed {} POIs from {} into {}".format(len(index), args.source, args.output))
+
+
+if __name__ == "__main__":
+    main()
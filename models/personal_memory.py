@@ -1,59 +1,146 @@
-import pandas as pd
+from collections import Counter, defaultdict, deque
 from .llm_api import LLMWrapper
 
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and value != value)
+
+
+class LongTermStats:
+    """
+    Statistics of the long term memory over a sliding window of the last `memory_lens` known stays
+    (all of them for memory_lens=0), updated in O(1) per new stay instead of recomputed per trajectory.
+
+    Counts are kept in Counters together with the positions of every key in the window, so that ties are
+    ranked by first occurrence in the window. The pandas value_counts this replaces left tied keys in the
+    order of numpy's unstable quicksort, which depends on the array size and the CPU.
+    """
+    def __init__(self, memory_lens=15):
+        self.maxlen = memory_lens if memory_lens > 0 else None
+        self.window = deque()
+        # absolute position of window[0]
+        self.start = 0
+
+        self.hour_counts = Counter()
+        self.hour_positions = defaultdict(deque)
+        self.venue_counts = Counter()
+        self.venue_positions = defaultdict(deque)
+        self.transition_counts = Counter()
+        self.transition_positions = defaultdict(deque)
+        self.hourly_venue_counts = defaultdict(Counter)
+        self.venue_id_positions = defaultdict(deque)
+
+    @staticmethod
+    def _add(counts, positions, key, pos):
+        if _is_missing(key):
+            return
+        counts[key] += 1
+        positions[key].append(pos)
+
+    @staticmethod
+    def _remove(counts, positions, key):
+        if _is_missing(key):
+            return
+        counts[key] -= 1
+        positions[key].popleft()
+        if counts[key] == 0:
+            del counts[key]
+            del positions[key]
+
+    @staticmethod
+    def _transition(venue, next_venue):
+        if _is_missing(venue) or _is_missing(next_venue):
+            return None
+        return venue + ' -> ' + next_venue
+
+    def add(self, stay):
+        stay = list(stay[:4])
+        if self.maxlen is not None and len(self.window) == self.maxlen:
+            self.evict()
+        pos = self.start + len(self.window)
+        hour, _, venue, venue_id = stay
+
+        if len(self.window) > 0:
+            self._add(self.transition_counts, self.transition_positions, self._transition(self.window[-1][2], venue), pos - 1)
+        self.window.append(stay)
+        self._add(self.hour_counts, self.hour_positions, hour, pos)
+        self._add(self.venue_counts, self.venue_positions, venue, pos)
+        if not (_is_missing(hour) or _is_missing(venue)):
+            self.hourly_venue_counts[hour][venue] += 1
+        self.venue_id_positions[venue_id].append(pos)
+
+    def extend(self, stays):
+        for stay in stays:
+            self.add(stay)
+        return self
+
+    def evict(self):
+        hour, _, venue, venue_id = self.window.popleft()
+        self.start += 1
+
+        if len(self.window) > 0:
+            self._remove(self.transition_counts, self.transition_positions, self._transition(venue, self.window[0][2]))
+        self._remove(self.hour_counts, self.hour_positions, hour)
+        self._remove(self.venue_counts, self.venue_positions, venue)
+        if not (_is_missing(hour) or _is_missing(venue)):
+            self.hourly_venue_counts[hour][venue] -= 1
+            if self.hourly_venue_counts[hour][venue] == 0:
+                del self.hourly_venue_counts[hour][venue]
+                if len(self.hourly_venue_counts[hour]) == 0:
+                    del self.hourly_venue_counts[hour]
+        self.venue_id_positions[venue_id].popleft()
+        if len(self.venue_id_positions[venue_id]) == 0:
+            del self.venue_id_positions[venue_id]
+
+    @staticmethod
+    def _ranked(counts, positions, name, k=None):
+        keys = sorted(counts, key=lambda x: (-counts[x], positions[x][0]))
+        if k is not None:
+            keys = keys[:k]
+        return [{name: key, 'Count': counts[key]} for key in keys]
+
+    def to_long_term_memory(self, k=5):
+        # id -> name of its latest stay, in order of first stay
+        venue_mapping = {
+            venue_id: self.window[positions[-1] - self.start][2]
+            for venue_id, positions in sorted(self.venue_id_positions.items(), key=lambda x: x[1][0])
+        }
+        hourly_venue_summary = []
+        for hour in sorted(self.hourly_venue_counts):
+            counts = self.hourly_venue_counts[hour]
+            venue = min(counts, key=lambda x: (-counts[x], x))
+            hourly_venue_summary.append({'Hour': hour, 'Venue_Category_Name': venue, 'Count': counts[venue]})
+
+        return {"venue_id_to_name": venue_mapping,
+                "top_k_frequent_hours": self._ranked(self.hour_counts, self.hour_positions, 'Hour', k),
+                "top_k_frequent_venues": self._ranked(self.venue_counts, self.venue_positions, 'Venue_Category_Name', k),
+                "hourly_venue_count": hourly_venue_summary,
+                "activity_transition": self._ranked(self.transition_counts, self.transition_positions, 'Transition')}
+
+
 class Memory:
-    def __init__(self, know_stays, context_stays, memory_lens=15):
+    def __init__(self, know_stays, context_stays, memory_lens=15, long_term_stats=None):
+        """long_term_stats: LongTermStats kept up to date by the caller, built from know_stays if not given"""
         self.long_term_memory = {}
         self.short_term_memory = []
         self.user_profile = ""
         self.memory_str_len=1000
         self.memory_lens=memory_lens
         
-        input_lens = min(len(know_stays), self.memory_lens)
-        self.write_memory(known_stays=know_stays[-input_lens:], context_stays=context_stays)
+        if long_term_stats is None:
+            input_lens = min(len(know_stays), self.memory_lens)
+            long_term_stats = LongTermStats(self.memory_lens).extend(know_stays[-input_lens:])
+        self.write_memory(long_term_stats=long_term_stats, context_stays=context_stays)
 
 
-    def write_memory(self, known_stays, context_stays):
+    def write_memory(self, long_term_stats, context_stays):
 
         """ 1) known_stays --> self.memory['long_term_memory'] """
-        known_stays_slim = []
-        for traj in known_stays:
-            known_stays_slim.append(traj[:4])
         context_stays_slim = []
         for traj in context_stays:
             context_stays_slim.append(traj[:4])
-        
-        venue_mapping = {entry[-1]: entry[-2] for entry in known_stays_slim}
-
-        df = pd.DataFrame(known_stays_slim, columns=['Hour', 'Weekday', 'Venue_Category_Name', 'Venue_ID'])
-        # df['Time_Period'] = df['Hour'].apply(self.get_time_period)
-
-        k = 5
-        hour_counts = df['Hour'].value_counts().sort_values(ascending=False)
-        top_hours = hour_counts.head(k).reset_index()
-        top_hours.columns = ['Hour', 'Count']
-
-
-        venue_counts = df['Venue_Category_Name'].value_counts().sort_values(ascending=False)
-        top_venues = venue_counts.head(k).reset_index()
-        top_venues.columns = ['Venue_Category_Name', 'Count']
-
-
-        hourly_venue_counts = df.groupby(['Hour', 'Venue_Category_Name']).size().reset_index(name='Count')
-        hourly_venue_summary = hourly_venue_counts.groupby('Hour').apply(
-            lambda x: x.nlargest(1, 'Count')).reset_index(drop=True)
-
-
-        df['Next_Venue'] = df['Venue_Category_Name'].shift(-1)
-        df['Transition'] = df['Venue_Category_Name'] + ' -> ' + df['Next_Venue']
-        transition_counts = df['Transition'].value_counts().reset_index()
-        transition_counts.columns = ['Transition', 'Count']
 
-        self.long_term_memory = {"venue_id_to_name": venue_mapping,
-                                f"top_k_frequent_hours": top_hours.to_dict('records'),
-                                f"top_k_frequent_venues": top_venues.to_dict('records'),
-                                "hourly_venue_count": hourly_venue_summary.to_dict('records'),
-                                f"activity_transition": transition_counts.to_dict('records')}
+        self.long_term_memory = long_term_stats.to_long_term_memory(k=5)
 
         """ 2) context_stays --> self.memory['short_term_memory'] """
         self.short_term_memory = {
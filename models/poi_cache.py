@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+from dataclasses import asdict
+from typing import List, Optional
+
+import numpy as np
+
+from models.osm_poi import POI
+from models.osm_poi_index import haversine_m
+
+
+# the MCP server runs without the agent environment, so it is configured by env variables instead of config.py
+POI_CACHE_PATH = os.environ.get("OSM_POI_CACHE_PATH", "results/poi_cache.sqlite")
+POI_CACHE_TTL_DAYS = float(os.environ.get("OSM_POI_CACHE_TTL_DAYS", 30))
+GEOHASH_PRECISION = int(os.environ.get("OSM_POI_GEOHASH_PRECISION", 7))  # 7 is a cell of about 153m x 153m
+
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash_encode(lat: float, lon: float, precision: int = GEOHASH_PRECISION) -> str:
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    code, bits, ch, even = [], 0, 0, True
+    while len(code) < precision:
+        value, rng = (lon, lon_range) if even else (lat, lat_range)
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            ch = ch * 2 + 1
+            rng[0] = mid
+        else:
+            ch = ch * 2
+            rng[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            code.append(GEOHASH_BASE32[ch])
+            bits, ch = 0, 0
+    return "".join(code)
+
+
+def geohash_bounds(code: str):
+    """((lat_min, lat_max), (lon_min, lon_max)) of a geohash cell"""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for c in code:
+        ch = GEOHASH_BASE32.index(c)
+        for shift in range(4, -1, -1):
+            rng = lon_range if even else lat_range
+            mid = (rng[0] + rng[1]) / 2
+            if (ch >> shift) & 1:
+                rng[0] = mid
+            else:
+                rng[1] = mid
+            even = not even
+    return tuple(lat_range), tuple(lon_range)
+
+
+def geohash_center(code: str):
+    (lat_min, lat_max), (lon_min, lon_max) = geohash_bounds(code)
+    return (lat_min + lat_max) / 2, (lon_min + lon_max) / 2
+
+
+def filter_pois(pois: List[POI], lat: float, lon: float, radius_m: int, poi_keys: List[str],
+                name_query: Optional[str], limit: int, split_by_key: bool) -> List[POI]:
+    """Narrow a superset result to a query: radius, keys, name regex, category by key order and limit"""
+    name_pattern = re.compile(name_query, re.IGNORECASE) if name_query else None
+    if pois:
+        dist = haversine_m(lat, lon, np.array([p.lat for p in pois]), np.array([p.lon for p in pois]))
+        pois = [p for p, d in zip(pois, dist) if d <= radius_m]
+    if name_pattern is not None:
+        pois = [p for p in pois if name_pattern.search(str(p.tags.get("name", "")))]
+
+    picked = {}
+    for keys in ([[k] for k in poi_keys] if split_by_key else [poi_keys]):
+        selected = [p for p in pois if any(k in p.tags for k in keys)][:limit]
+        picked.update({(p.osm_type, p.osm_id): p for p in selected if (p.osm_type, p.osm_id) not in picked})
+
+    out = []
+    for p in picked.values():
+        category, value = "", ""
+        for k in poi_keys:
+            if k in p.tags:
+                category, value = k, str(p.tags[k])
+                break
+        out.append(POI(p.osm_type, p.osm_id, p.lat, p.lon, p.name, category, value, p.tags))
+    return out
+
+
+class POICache:
+    """
+    Disk-backed (SQLite) cache of get_nearby_pois results, keyed by the geohash cell of the query point.
+
+    Nearby check-ins share one entry: it holds the POIs around the center of their cell, within the query radius
+    plus half the cell diagonal, so it covers the query circle of every point of the cell, and every lookup is
+    filtered against the real query point. An entry also serves narrower queries in the same cell: a larger
+    radius, a superset of the keys and no name filter are filtered locally, as long as the cached result was
+    not cut off by its limit. Entries older than ttl_days are ignored and evicted.
+    """
+    def __init__(self, path=POI_CACHE_PATH, ttl_days=POI_CACHE_TTL_DAYS, precision=GEOHASH_PRECISION, evict_every=200):
+        self.path = path
+        self.ttl_s = ttl_days * 24 * 3600
+        self.precision = precision
+        self.evict_every = evict_every
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pois ("
+            "cell TEXT NOT NULL, radius_m INTEGER NOT NULL, poi_keys TEXT NOT NULL, name_query TEXT NOT NULL, "
+            "osm_types TEXT NOT NULL, lim INTEGER NOT NULL, split_by_key INTEGER NOT NULL, complete INTEGER NOT NULL, "
+            "pois TEXT NOT NULL, created_at REAL NOT NULL, "
+            "PRIMARY KEY (cell, radius_m, poi_keys, name_query, osm_types, lim, split_by_key))"
+        )
+        self.conn.commit()
+        self.evict()
+
+    def snap(self, lat: float, lon: float):
+        cell = geohash_encode(lat, lon, self.precision)
+        return (cell,) + geohash_center(cell)
+
+    def fetch_params(self, lat: float, lon: float, radius_m: int, limit: int):
+        """
+        (center_lat, center_lon, radius_m, limit) of the query that fills the entry of the cell of (lat, lon):
+        the radius grows by half the cell diagonal, and the limit with the area, so that about as many POIs
+        end up inside the real query circle
+        """
+        cell, center_lat, center_lon = self.snap(lat, lon)
+        (lat_min, _), (lon_min, _) = geohash_bounds(cell)
+        fetch_radius_m = radius_m + int(np.ceil(float(haversine_m(center_lat, center_lon, lat_min, lon_min))))
+        fetch_limit = int(np.ceil(limit * (fetch_radius_m / max(radius_m, 1)) ** 2))
+        return center_lat, center_lon, fetch_radius_m, fetch_limit
+
+    def get(self, lat, lon, radius_m, poi_keys, name_query, limit, split_by_key, osm_types) -> Optional[List[POI]]:
+        cell, _, _ = self.snap(lat, lon)
+        _, _, fetch_radius_m, _ = self.fetch_params(lat, lon, radius_m, limit)
+        exact = (fetch_radius_m, ",".join(poi_keys), name_query or "", limit, int(split_by_key))
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT radius_m, poi_keys, name_query, lim, split_by_key, complete, pois FROM pois "
+                "WHERE cell=? AND osm_types=? AND radius_m>=? AND created_at>=? ORDER BY radius_m ASC",
+                (cell, ",".join(osm_types), fetch_radius_m, time.time() - self.ttl_s if self.ttl_s > 0 else 0),
+            ).fetchall()
+        for row in rows:
+            if tuple(row[:5]) == exact or (row[5] and set(poi_keys) <= set(row[1].split(",")) and row[2] in ("", name_query or "")):
+                self.hits += 1
+                pois = [POI(**p) for p in json.loads(row[6])]
+                return filter_pois(pois, lat, lon, radius_m, poi_keys, name_query, limit, split_by_key)
+        self.misses += 1
+        return None
+
+    def put(self, lat, lon, radius_m, poi_keys, name_query, limit, split_by_key, osm_types, pois: List[POI]) -> None:
+        """pois: the result of the query given by fetch_params for this point, radius and limit"""
+        cell, _, _ = self.snap(lat, lon)
+        _, _, fetch_radius_m, fetch_limit = self.fetch_params(lat, lon, radius_m, limit)
+        # a result that reached its limit may miss POIs, only the exact same query can reuse it
+        key_groups = [[k] for k in poi_keys] if split_by_key else [poi_keys]
+        complete = all(sum(any(k in p.tags for k in keys) for p in pois) < fetch_limit for keys in key_groups)
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pois VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (cell, fetch_radius_m, ",".join(poi_keys), name_query or "", ",".join(osm_types), limit, int(split_by_key),
+                 int(complete), json.dumps([asdict(p) for p in pois], ensure_ascii=False), time.time()),
+            )
+            self.conn.commit()
+            self.writes += 1
+        if self.writes % self.evict_every == 0:
+            self.evict()
+
+    def evict(self):
+        if self.ttl_s <= 0:
+            return
+        with self.lock:
+            self.conn.execute("DELETE FROM pois WHERE created_at < ?", (time.time() - self.ttl_s,))
+            self.conn.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -1,4 +1,5 @@
-from utils import haversine_distance
+from collections import Counter
+from utils import haversine_distance, token_count
 import json  # 确保加入此行
 COMMON_PROMPT = """
 ## Task
@@ -77,36 +78,99 @@ def prompt_generator_llmzs(v):
     return prompt
 
 
-def prompt_generator_agent(v, prompt_type, spatial_world_info, memory_info, social_world_info, poi_info):
-    prompt = ''
-    if prompt_type == "agent_move_v6":
-        prompt = f"""
+# The agent prompt runs from the most to the least shared part, so the serving side (vLLM automatic prefix caching,
+# provider prompt caching) reuses the KV cache of a prefix: static instructions are the same for the whole run,
+# the personal memory for the samples of a user, and only the trajectory context is new in every request
+AGENT_PROMPT_PREFIX = f"""
 {COMMON_PROMPT}
 3. The potential places that users may visit based on an overall analysis of multi-level urban spaces.
 4. The personal profile and memory info extracted from the long trajectory history of each user.
+{OUTPUT_PROMPT}
+"""
+USER_SECTION = "## The personal profile and long memory:"
+TRAJECTORY_SECTION = "## The potential places from the global spatial view:"
+
+
+def prompt_generator_agent(v, prompt_type, spatial_world_info, memory_info, social_world_info, poi_info):
+    prompt = ''
+    if prompt_type == "agent_move_v6":
+        user_prompt = f"""{USER_SECTION}
+<historical_info>: {memory_info['historical_info']}
+<user_profile>: {memory_info['user_profile']}
 
-## The potential places from the global spatial view:
+"""
+        trajectory_prompt = f"""{TRAJECTORY_SECTION}
 {spatial_world_info}
 
 ## The nearby places visited by other users with similar mobility pattern:
 {social_world_info}
 
-## The personal profile and long memory:
-<historical_info>: {memory_info['historical_info']}
-<user_profile>: {memory_info['user_profile']}
+## Nearby Points of Interest:
+{poi_info}
 
 ## The history data:
 <historical_stays>: {[[item[0], item[1], item[2], item[3], ",".join((item[5],item[7],item[6]))] for item in v['historical_stays']]}
 <context_stays>: {[[item[0], item[1], item[2], item[3], ",".join((item[5],item[7],item[6]))] for item in v['context_stays']]}
 <target_stay>: {[v['target_stay'][0], v['target_stay'][1], v['target_stay'][2]]}
-
-## Nearby Points of Interest:
-{json.dumps(poi_info, ensure_ascii=False, indent=2)}  # Added POI data
-
-{OUTPUT_PROMPT}
 """
+        prompt = AGENT_PROMPT_PREFIX + user_prompt + trajectory_prompt
     return prompt
 
+
+def get_prompt_prefix(prompt_text, per_user=True):
+    """
+    Stable prefix of an agent prompt: the static instructions shared by the whole run, plus the personal memory
+    shared by the samples of a user when per_user. Empty for other prompts.
+    """
+    if not prompt_text.startswith(AGENT_PROMPT_PREFIX):
+        return ""
+    if not per_user:
+        return AGENT_PROMPT_PREFIX
+    end = prompt_text.find(TRAJECTORY_SECTION, len(AGENT_PROMPT_PREFIX))
+    return prompt_text[:end] if end >= 0 else AGENT_PROMPT_PREFIX
+
+def format_poi_info(poi_info, lat, lon, token_budget=400):
+    """
+    Compact table of the MCP POI result for the agent prompt, cut to token_budget tokens.
+
+    POIs are ranked round by round: the nearest POI of every type first, rarer types ahead of common
+    ones, then the second nearest of every type, and so on; distances are in meters from (lat, lon).
+    """
+    pois = (poi_info or {}).get("pois") or []
+    if not pois:
+        return "None"
+
+    rows = sorted(
+        (int(haversine_distance(lat, lon, p["lat"], p["lon"]) * 1000), "{}={}".format(p.get("category") or "other", p.get("value") or ""), p.get("name") or "-")
+        for p in pois
+    )
+    type_counts = Counter(poi_type for _, poi_type, _ in rows)
+    type_rank = Counter()
+    ranked = []
+    for distance_m, poi_type, name in rows:
+        ranked.append((type_rank[poi_type], type_counts[poi_type], distance_m, poi_type, name))
+        type_rank[poi_type] += 1
+    ranked.sort()
+
+    top_types = ", ".join("{}({})".format(t, c) for t, c in type_counts.most_common(8))
+    lines = [
+        "{} POIs within {}m of the last check-in, most frequent types: {}".format(len(pois), poi_info.get("radius_m"), top_types),
+        "name | type | distance_m",
+    ]
+    used = token_count("\n".join(lines))
+    omitted_reserve = 10
+    for _, _, distance_m, poi_type, name in ranked:
+        line = "{} | {} | {}".format(name.replace("|", "/"), poi_type, distance_m)
+        cost = token_count(line) + 1
+        if used + cost > token_budget - omitted_reserve:
+            break
+        lines.append(line)
+        used += cost
+    if len(lines) - 2 < len(pois):
+        lines.append("(+{} more omitted)".format(len(pois) - (len(lines) - 2)))
+    return "\n".join(lines)
+
+
 def prompt_generator_llmmove(v, rec):
     prompt =f"""\
 <long-term check-ins> [Format: (POIID, Category)]: {[(item[3],item[2]) for item in v['historical_stays']]}
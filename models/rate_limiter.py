@@ -0,0 +1,155 @@
+import time
+import asyncio
+import threading
+from contextlib import contextmanager, asynccontextmanager
+
+from config import LLM_RATE_LIMITS, LLM_RATE_LIMIT_DEFAULT
+
+
+class RateLimiter:
+    """
+    Token-bucket limiter of requests and tokens per minute plus a cap on requests in flight, for one
+    (platform, model) and shared by every thread and the event loop of the process.
+
+    Limits adapt to the provider: a 429 halves the rate and the concurrency cap and pauses all callers for
+    Retry-After seconds; every success raises them again step by step (AIMD) up to the configured limits.
+    rpm, tpm or max_concurrency of 0 disables that limit.
+    """
+    def __init__(self, rpm=0, tpm=0, max_concurrency=0, burst_s=5.0, min_scale=0.05, default_pause_s=2.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.burst_s = burst_s
+        self.min_scale = min_scale
+        self.default_pause_s = default_pause_s
+
+        self.lock = threading.Lock()
+        self.slot_free = threading.Condition(self.lock)
+        self.scale = 1.0
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.request_level = rpm / 60 * burst_s
+        self.token_level = tpm / 60 * burst_s
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+        self.requests = 0
+        self.rate_limited = 0
+        self.waited_s = 0.0
+
+    def _refill(self, now):
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        if self.rpm:
+            self.request_level = min(self.request_level + elapsed * self.rpm * self.scale / 60, self.rpm / 60 * self.burst_s)
+        if self.tpm:
+            self.token_level = min(self.token_level + elapsed * self.tpm * self.scale / 60, self.tpm / 60 * self.burst_s)
+
+    def reserve(self, tokens):
+        """take one request and `tokens` tokens now, returns the seconds to wait before sending"""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(self.paused_until - now, 0.0)
+            if self.rpm:
+                self.request_level -= 1
+                wait = max(wait, -self.request_level / (self.rpm * self.scale / 60))
+            if self.tpm:
+                self.token_level -= tokens
+                wait = max(wait, -self.token_level / (self.tpm * self.scale / 60))
+            self.requests += 1
+            self.waited_s += wait
+        return wait
+
+    def adjust_tokens(self, tokens):
+        """charge (or refund) the difference between the estimated and the reported tokens of a request"""
+        if self.tpm:
+            with self.lock:
+                self.token_level -= tokens
+
+    def _enter(self):
+        if self.max_concurrency and self.in_flight >= int(self.concurrency):
+            return False
+        self.in_flight += 1
+        return True
+
+    def _leave(self):
+        with self.lock:
+            self.in_flight -= 1
+            self.slot_free.notify()
+
+    @contextmanager
+    def limit(self, tokens):
+        time.sleep(self.reserve(tokens))
+        with self.lock:
+            while not self._enter():
+                self.slot_free.wait()
+        try:
+            yield
+        finally:
+            self._leave()
+
+    @asynccontextmanager
+    async def alimit(self, tokens, poll_s=0.02):
+        await asyncio.sleep(self.reserve(tokens))
+        while True:
+            with self.lock:
+                if self._enter():
+                    break
+            await asyncio.sleep(poll_s)
+        try:
+            yield
+        finally:
+            self._leave()
+
+    def on_success(self):
+        with self.lock:
+            self.scale = min(1.0, self.scale + 0.05)
+            if self.max_concurrency:
+                self.concurrency = min(float(self.max_concurrency), self.concurrency + 1 / max(self.concurrency, 1.0))
+                self.slot_free.notify()
+
+    def on_rate_limited(self, retry_after_s=None):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.rate_limited += 1
+            self.scale = max(self.min_scale, self.scale / 2)
+            if self.max_concurrency:
+                self.concurrency = max(1.0, self.concurrency / 2)
+            pause = retry_after_s if retry_after_s is not None else self.default_pause_s
+            self.paused_until = max(self.paused_until, now + pause)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "rate_limited": self.rate_limited,
+                "waited_s": round(self.waited_s, 2),
+                "rate_scale": round(self.scale, 3),
+                "concurrency": int(self.concurrency) if self.max_concurrency else None,
+            }
+
+
+def get_retry_after(error):
+    """seconds from the Retry-After header of a 429 response (openai.RateLimitError), None when missing"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    value = response.headers.get("retry-after")
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+# one limiter per (platform, model) per process
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+def get_rate_limiter(platform, model_name):
+    with _LIMITERS_LOCK:
+        if (platform, model_name) not in _LIMITERS:
+            _LIMITERS[(platform, model_name)] = RateLimiter(**LLM_RATE_LIMITS.get(platform, LLM_RATE_LIMIT_DEFAULT))
+        return _LIMITERS[(platform, model_name)]
@@ -0,0 +1,283 @@
+import numpy as np
+
+from models.npz_io import save_npz_atomic
+
+
+NODE_ATTRS = ["category", "admin", "subdistrict", "street", "poi"]
+
+
+def csr_from_entries(num_rows, rows, cols, counts):
+    """Sum duplicated (row, col) entries into CSR arrays, every row sorted by count (highest first), ties by col"""
+    num_cols = int(max(cols.max() + 1 if len(cols) else 1, 1))
+    keys, inverse = np.unique(np.asarray(rows, dtype=np.int64) * num_cols + np.asarray(cols, dtype=np.int64), return_inverse=True)
+    counts = np.bincount(inverse, weights=counts, minlength=len(keys)).astype(np.int32)
+    rows, cols = keys // num_cols, keys % num_cols
+    order = np.lexsort((cols, -counts.astype(np.int64), rows))
+    indptr = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=num_rows), out=indptr[1:])
+    return indptr, cols[order].astype(np.int32), counts[order]
+
+
+def merge_counts(indices, counts, delta):
+    """merge a CSR row with a {col: count} delta, returned sorted like a CSR row"""
+    merged = dict(zip(indices.tolist(), counts.tolist()))
+    for col, count in delta.items():
+        merged[col] = merged.get(col, 0) + count
+    ranked = sorted(merged.items(), key=lambda x: (-x[1], x[0]))
+    return np.array([x[0] for x in ranked], dtype=np.int32), np.array([x[1] for x in ranked], dtype=np.int32)
+
+
+class VenueGraph:
+    """
+    Venue transition graph of SocialWorld in CSR form.
+
+    Venues are indexed by integers, the neighbors of venue i are indices[indptr[i]:indptr[i+1]] with the
+    transition counts in weights, sorted by count (highest first), and every node attribute is one array
+    aligned with venue_ids. Saved and loaded as a single .npz file.
+
+    Venues and edges added after the build (add_venue, add_edge) are kept in small delta dicts that are
+    merged at query time, compact() folds them into the CSR arrays.
+    """
+    def __init__(self, venue_ids, indptr, indices, weights, attrs, applied_seq=0):
+        self.venue_ids = venue_ids
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.attrs = attrs
+        self.node_index = {venue_id: i for i, venue_id in enumerate(venue_ids.tolist())}
+        # sequence number of the last update folded into the CSR arrays
+        self.applied_seq = int(applied_seq)
+
+        self.num_base = len(venue_ids)
+        self.new_venue_ids = []
+        self.attr_updates = {}
+        self.delta = {}
+
+    def sort_neighbors(self):
+        """order every CSR row by transition count, highest first, ties by venue index"""
+        rows = np.repeat(np.arange(self.num_base), np.diff(self.indptr))
+        order = np.lexsort((self.indices, -self.weights.astype(np.int64), rows))
+        self.indices = self.indices[order]
+        self.weights = self.weights[order]
+
+    @classmethod
+    def from_arrays(cls, venue_ids, src, dst, counts, attrs):
+        """
+        venue_ids: venue id of every venue index, src/dst/counts: transition counts between venue indices,
+        transitions in both directions are merged into one undirected edge. attrs: {attr: array aligned with venue_ids}
+        """
+        low, high = np.minimum(src, dst), np.maximum(src, dst)
+        mirror = low != high
+        rows = np.concatenate([low, high[mirror]])
+        cols = np.concatenate([high, low[mirror]])
+        counts = np.concatenate([counts, counts[mirror]])
+        indptr, indices, weights = csr_from_entries(len(venue_ids), rows, cols, counts)
+        return cls(venue_ids, indptr, indices, weights, attrs)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        graph = cls(data["venue_ids"], data["indptr"], data["indices"], data["weights"],
+                    {attr: data[attr] for attr in NODE_ATTRS},
+                    data["applied_seq"] if "applied_seq" in data.files else 0)
+        graph.sort_neighbors()
+        return graph
+
+    def save(self, path):
+        save_npz_atomic(path, venue_ids=self.venue_ids, indptr=self.indptr, indices=self.indices, weights=self.weights,
+                        applied_seq=self.applied_seq, **self.attrs)
+
+    def __contains__(self, venue_id):
+        return str(venue_id) in self.node_index
+
+    def __len__(self):
+        return self.num_base + len(self.new_venue_ids)
+
+    def index(self, venue_id):
+        return self.node_index.get(str(venue_id))
+
+    def venue_id(self, i):
+        return self.venue_ids[i] if i < self.num_base else self.new_venue_ids[i - self.num_base]
+
+    def add_venue(self, venue_id, attrs):
+        """index of venue_id, added if new; attrs (of its latest stay) replace the stored ones"""
+        venue_id = str(venue_id)
+        i = self.node_index.get(venue_id)
+        if i is None:
+            i = len(self)
+            self.node_index[venue_id] = i
+            self.new_venue_ids.append(venue_id)
+        self.attr_updates[i] = {attr: str(attrs.get(attr, "")) for attr in NODE_ATTRS}
+        return i
+
+    def add_edge(self, i, j, count=1):
+        self.delta.setdefault(i, {})
+        self.delta[i][j] = self.delta[i].get(j, 0) + count
+        if i != j:
+            self.delta.setdefault(j, {})
+            self.delta[j][i] = self.delta[j].get(i, 0) + count
+
+    def neighbors(self, i):
+        """(neighbor indices, transition counts) of venue index i"""
+        if i < self.num_base:
+            start, end = self.indptr[i], self.indptr[i + 1]
+            indices, weights = self.indices[start:end], self.weights[start:end]
+        else:
+            indices, weights = np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+        if i in self.delta:
+            return merge_counts(indices, weights, self.delta[i])
+        return indices, weights
+
+    def khop_neighbors(self, i, khop):
+        """
+        [(neighbor index, hop, weight)] within khop hops of venue index i, i itself excluded. Venues are
+        ordered by hop and then by weight, the transition count from the venues of the previous hop.
+        """
+        visited = {i}
+        frontier = [i]
+        result = []
+        for hop in range(1, khop + 1):
+            scores = {}
+            for node in frontier:
+                neighbors, weights = self.neighbors(node)
+                for neighbor, weight in zip(neighbors.tolist(), weights.tolist()):
+                    if neighbor not in visited:
+                        scores[neighbor] = scores.get(neighbor, 0) + weight
+            ranked = sorted(scores.items(), key=lambda x: (-x[1], x[0]))
+            result.extend((neighbor, hop, weight) for neighbor, weight in ranked)
+            visited.update(scores)
+            frontier = [neighbor for neighbor, _ in ranked]
+        return result
+
+    def node(self, i):
+        if i in self.attr_updates:
+            return self.attr_updates[i]
+        return {attr: self.attrs[attr][i] for attr in NODE_ATTRS}
+
+    def compact(self, applied_seq):
+        """fold the added venues and edges into the CSR arrays"""
+        rows = [np.repeat(np.arange(self.num_base), np.diff(self.indptr))]
+        cols = [self.indices]
+        counts = [self.weights]
+        for i, delta in self.delta.items():
+            rows.append(np.full(len(delta), i, dtype=np.int64))
+            cols.append(np.array(list(delta.keys()), dtype=np.int64))
+            counts.append(np.array(list(delta.values()), dtype=np.int64))
+        venue_ids = np.array(self.venue_ids.tolist() + self.new_venue_ids, dtype=str)
+        attrs = {}
+        for attr in NODE_ATTRS:
+            values = self.attrs[attr].tolist() + [""] * len(self.new_venue_ids)
+            for i, node_attrs in self.attr_updates.items():
+                values[i] = node_attrs[attr]
+            attrs[attr] = np.array(values, dtype=str)
+        indptr, indices, weights = csr_from_entries(
+            len(venue_ids), np.concatenate(rows), np.concatenate(cols), np.concatenate(counts)
+        )
+        self.__init__(venue_ids, indptr, indices, weights, attrs, applied_seq)
+
+
+HOUR_BUCKET_SIZE = 3 # hours per time bucket of the transition index
+WEEKEND_DAYS = ["Saturday", "Sunday"]
+
+
+def parse_hour(hour):
+    """'9 AM' / '12 PM' / '0 AM' (see processing/data.py) or an int -> hour of day 0-23"""
+    if isinstance(hour, str):
+        value, am_pm = hour.split(" ")
+        value = int(value)
+        if am_pm == "PM" and value != 12:
+            value += 12
+        return value
+    return int(hour)
+
+
+class TransitionIndex:
+    """
+    Directed venue transitions keyed by (src venue, hour bucket, weekday/weekend) of the next stay.
+
+    Stored as one sparse count matrix in CSR form: row src * num_slots + slot holds the venues people moved
+    to from src in that time slot, with counts sorted highest first, so a query is a single row slice.
+    Venue indices are those of the VenueGraph built from the same stays. Transitions added after the build
+    are kept in a delta dict per row until compact().
+    """
+    def __init__(self, indptr, indices, counts, hour_bucket_size=HOUR_BUCKET_SIZE, applied_seq=0):
+        self.indptr = indptr
+        self.indices = indices
+        self.counts = counts
+        self.hour_bucket_size = int(hour_bucket_size)
+        self.num_slots = 2 * -(-24 // self.hour_bucket_size)
+        self.applied_seq = int(applied_seq)
+        self.delta = {}
+
+    def time_slot(self, hour, weekday):
+        return (parse_hour(hour) // self.hour_bucket_size) * 2 + int(weekday in WEEKEND_DAYS)
+
+    @classmethod
+    def from_stays(cls, node_index, trajectories, hour_bucket_size=HOUR_BUCKET_SIZE):
+        """
+        node_index: {venue_id: venue index}, trajectories: list of stay lists ([hour, weekday, category, venue_id, ...]),
+        consecutive stays of one list are the transitions
+        """
+        num_venues = len(node_index)
+        num_slots = 2 * -(-24 // hour_bucket_size)
+        stays = [stay for traj in trajectories for stay in traj]
+        traj_ids = np.repeat(np.arange(len(trajectories)), [len(traj) for traj in trajectories])
+
+        venues = np.array([node_index[str(stay[3])] for stay in stays], dtype=np.int64)
+        hours, hour_inverse = np.unique(np.array([str(stay[0]) for stay in stays]), return_inverse=True)
+        days, day_inverse = np.unique(np.array([str(stay[1]) for stay in stays]), return_inverse=True)
+        hour_buckets = np.array([parse_hour(hour) // hour_bucket_size for hour in hours], dtype=np.int64)
+        weekend = np.isin(days, WEEKEND_DAYS).astype(np.int64)
+        slots = hour_buckets[hour_inverse] * 2 + weekend[day_inverse]
+
+        # transition i: stay i -> stay i+1 of the same trajectory, in the time slot of stay i+1
+        same_traj = traj_ids[:-1] == traj_ids[1:]
+        rows = (venues[:-1] * num_slots + slots[1:])[same_traj]
+        cols = venues[1:][same_traj]
+        indptr, indices, counts = csr_from_entries(num_venues * num_slots, rows, cols, np.ones(len(rows), dtype=np.int64))
+        return cls(indptr, indices, counts, hour_bucket_size)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["indptr"], data["indices"], data["counts"], data["hour_bucket_size"],
+                   data["applied_seq"] if "applied_seq" in data.files else 0)
+
+    def save(self, path):
+        save_npz_atomic(path, indptr=self.indptr, indices=self.indices, counts=self.counts,
+                        hour_bucket_size=self.hour_bucket_size, applied_seq=self.applied_seq)
+
+    def num_venues(self):
+        return (len(self.indptr) - 1) // self.num_slots
+
+    def add(self, i, j, hour, weekday, count=1):
+        """transition from venue index i to j, with (hour, weekday) of the stay at j"""
+        row = i * self.num_slots + self.time_slot(hour, weekday)
+        self.delta.setdefault(row, {})
+        self.delta[row][j] = self.delta[row].get(j, 0) + count
+
+    def transitions(self, i, hour, weekday):
+        """(next venue indices, counts) from venue index i in the time slot of (hour, weekday), highest count first"""
+        row = i * self.num_slots + self.time_slot(hour, weekday)
+        if row < len(self.indptr) - 1:
+            start, end = self.indptr[row], self.indptr[row + 1]
+            indices, counts = self.indices[start:end], self.counts[start:end]
+        else:
+            indices, counts = np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+        if row in self.delta:
+            return merge_counts(indices, counts, self.delta[row])
+        return indices, counts
+
+    def compact(self, num_venues, applied_seq):
+        """fold the added transitions into the CSR arrays, with rows for num_venues venues"""
+        rows = [np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr))]
+        cols = [self.indices]
+        counts = [self.counts]
+        for row, delta in self.delta.items():
+            rows.append(np.full(len(delta), row, dtype=np.int64))
+            cols.append(np.array(list(delta.keys()), dtype=np.int64))
+            counts.append(np.array(list(delta.values()), dtype=np.int64))
+        indptr, indices, counts = csr_from_entries(
+            num_venues * self.num_slots, np.concatenate(rows), np.concatenate(cols), np.concatenate(counts)
+        )
+        self.__init__(indptr, indices, counts, self.hour_bucket_size, applied_seq)
@@ -0,0 +1,181 @@
+import re
+import time
+import threading
+
+from utils import get_token_encoder, token_count
+from models.prompts import AGENT_PROMPT_PREFIX, USER_SECTION
+
+
+TRUNCATION_MARK = "...\n"
+# a prompt section starts with a markdown heading at the beginning of a line, see models/prompts.py
+SECTION_PATTERN = re.compile(r"(?m)^(?=## )")
+# a field of the personal memory section, e.g. "<historical_info>: ..."
+FIELD_PATTERN = re.compile(r"(?m)^(?=<\w+>: )")
+# largest share of the budget after the instructions that the personal memory section keeps
+USER_SECTION_MAX_SHARE = 0.5
+
+
+def encode_tokens(text):
+    encoding = get_token_encoder()
+    if encoding is None:
+        # same 4 characters per token estimate as utils.token_count
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+    return encoding.encode(text, disallowed_special=())
+
+
+def decode_tokens(tokens):
+    encoding = get_token_encoder()
+    if encoding is None:
+        return "".join(tokens)
+    return encoding.decode(tokens)
+
+
+def fits_token_budget(text, max_tokens):
+    """(fits, exact token count or None); every token covers at least one byte, so short texts are never counted"""
+    if len(text.encode("utf-8")) <= max_tokens:
+        return True, None
+    num_tokens = token_count(text)
+    return num_tokens <= max_tokens, num_tokens
+
+
+def truncate_head_tail(text, max_tokens, head_ratio=0.25):
+    tokens = encode_tokens(text)
+    if len(tokens) <= max_tokens:
+        return text
+    mark_tokens = len(encode_tokens(TRUNCATION_MARK))
+    if max_tokens <= mark_tokens:
+        return decode_tokens(tokens[-max_tokens:]) if max_tokens > 0 else ""
+    head = int((max_tokens - mark_tokens) * head_ratio)
+    tail = max(max_tokens - mark_tokens - head, 0)
+    return decode_tokens(tokens[:head]) + TRUNCATION_MARK + (decode_tokens(tokens[-tail:]) if tail else "")
+
+
+def truncate_section(section, max_tokens):
+    """keep the heading line and the end of the body, the most recent stays are listed last"""
+    tokens = encode_tokens(section)
+    if len(tokens) <= max_tokens:
+        return section
+    heading, _, body = section.partition("\n")
+    heading = heading + "\n" + TRUNCATION_MARK
+    keep = max_tokens - len(encode_tokens(heading))
+    body_tokens = encode_tokens(body)
+    return heading + (decode_tokens(body_tokens[-keep:]) if keep > 0 else "")
+
+
+def fair_shares(sizes, budget):
+    """max-min fair share: parts smaller than an even share keep their length, the rest split what is left"""
+    shares = [0] * len(sizes)
+    remaining = budget
+    for k, i in enumerate(sorted(range(len(sizes)), key=lambda i: sizes[i])):
+        shares[i] = min(sizes[i], remaining // (len(sizes) - k))
+        remaining -= shares[i]
+    return shares
+
+
+def truncate_fields(section, max_tokens):
+    """cut the values of a "<label>: value" section from the middle, the heading and every label are kept"""
+    if fits_token_budget(section, max_tokens)[0]:
+        return section
+    heading, _, body = section.partition("\n")
+    fields = [f for f in FIELD_PATTERN.split(body) if f]
+    labels = [f[:f.index(": ") + 2] if f.startswith("<") else "" for f in fields]
+    values = [f[len(label):] for f, label in zip(fields, labels)]
+    fixed = len(encode_tokens(heading + "\n" + "".join(labels)))
+    mark_tokens = len(encode_tokens(TRUNCATION_MARK))
+    shares = fair_shares([len(encode_tokens(v)) for v in values], max(max_tokens - fixed, 0))
+    cut = [v if len(encode_tokens(v)) <= n else (truncate_head_tail(v, n) if n > mark_tokens else TRUNCATION_MARK)
+           for v, n in zip(values, shares)]
+    return heading + "\n" + "".join(label + v for label, v in zip(labels, cut))
+
+
+def truncate_prompt(text, max_tokens, num_tokens=None, prefix=AGENT_PROMPT_PREFIX):
+    """
+    Cut a prompt to max_tokens tokens (exact when the tokenizer is available).
+
+    The instruction prefix (task and output format, see models/prompts.py) is kept whole. The budget is taken
+    from the per-trajectory sections first: the personal memory section is only cut, keeping its field labels,
+    when it is longer than USER_SECTION_MAX_SHARE of the budget left by the instructions. The per-trajectory
+    sections after it share the budget left, small sections are kept whole and the largest ones are cut from
+    the front. Prompts without sections keep their beginning and end.
+    """
+    if num_tokens is None:
+        fits, _ = fits_token_budget(text, max_tokens)
+        if fits:
+            return text
+    elif num_tokens <= max_tokens:
+        return text
+
+    head = prefix if prefix and text.startswith(prefix) else ""
+    middle = [p for p in SECTION_PATTERN.split(text[len(head):]) if p]
+    if not any(p.startswith("## ") for p in middle):
+        return truncate_head_tail(text, max_tokens)
+    if middle[0].startswith(USER_SECTION):
+        head += truncate_fields(middle[0], int((max_tokens - len(encode_tokens(head))) * USER_SECTION_MAX_SHARE))
+        middle = middle[1:]
+    budget = max_tokens - len(encode_tokens(head))
+    if budget <= 0:
+        return truncate_head_tail(text, max_tokens)
+
+    shares = fair_shares([len(encode_tokens(p)) for p in middle], budget)
+    context = "".join(truncate_section(p, n) for p, n in zip(middle, shares))
+
+    # tokens can merge across section boundaries, a last exact pass keeps the budget a hard limit and only
+    # cuts the per-trajectory context
+    overflow = len(encode_tokens(head + context)) - max_tokens
+    if overflow > 0:
+        context = truncate_head_tail(context, max(len(encode_tokens(context)) - overflow - 1, 0))
+    return head + context
+
+
+class TokenMetrics:
+    """Per LLMWrapper counters of prompt truncation and of the token usage reported by the API"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.prompts = 0
+        self.exact_counts = 0
+        self.truncated = 0
+        self.budget_time_s = 0.0
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        # prompt tokens served from the provider's prefix cache, when the API reports them
+        self.cached_prompt_tokens = 0
+
+    def budget(self, prompt_text, max_tokens):
+        start = time.perf_counter()
+        fits, num_tokens = fits_token_budget(prompt_text, max_tokens)
+        truncated = prompt_text if fits else truncate_prompt(prompt_text, max_tokens, num_tokens)
+        with self.lock:
+            self.prompts += 1
+            self.exact_counts += num_tokens is not None
+            self.truncated += not fits
+            self.budget_time_s += time.perf_counter() - start
+        return truncated
+
+    def record_usage(self, usage):
+        if usage is None:
+            return
+        with self.lock:
+            self.requests += 1
+            self.prompt_tokens += getattr(usage, "prompt_tokens", 0) or 0
+            self.completion_tokens += getattr(usage, "completion_tokens", 0) or 0
+            details = getattr(usage, "prompt_tokens_details", None)
+            # the pinned openai==1.25 keeps fields it does not know, like this one, as plain dicts
+            if isinstance(details, dict):
+                self.cached_prompt_tokens += details.get("cached_tokens", 0) or 0
+            else:
+                self.cached_prompt_tokens += getattr(details, "cached_tokens", 0) or 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "prompts": self.prompts,
+                "exact_counts": self.exact_counts,
+                "truncated": self.truncated,
+                "budget_ms_per_prompt": round(self.budget_time_s * 1000 / self.prompts, 3) if self.prompts else 0.0,
+                "requests": self.requests,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "cached_prompt_tokens": self.cached_prompt_tokens,
+                "prefix_cache_hit_rate": round(self.cached_prompt_tokens / self.prompt_tokens, 4) if self.prompt_tokens else 0.0,
+            }
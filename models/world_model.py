@@ -1,11 +1,14 @@
 import os
 import glob
-import networkx as nx
+import json
+import asyncio
 import itertools
+import numpy as np
 import pandas as pd
-from collections import Counter
+from functools import lru_cache
 
 from .llm_api import LLMWrapper
+from .social_graph import VenueGraph, TransitionIndex, NODE_ATTRS, WEEKEND_DAYS
 from config import CITY_DATA_DIR
 
 
@@ -13,12 +16,13 @@ class SpatialWorld:
     """
     World Knowledge Generator
     """
-    def __init__(self, platform, model_name, city_name, traj_seqs, explore_num=5):
+    def __init__(self, platform, model_name, city_name, traj_seqs, explore_num=5, llm=None, build_world=True):
         self.city_name = city_name
         self.max_lens = 1000
         self.max_history = 50
         
-        self.llm = LLMWrapper(model_name, platform)
+        # reuse the caller's LLMWrapper (and its HTTP clients) when given
+        self.llm = llm if llm is not None else LLMWrapper(model_name, platform)
 
         his_addresses_len = min(len(traj_seqs['historical_addr']), self.max_history)
         traj_pos = [[his[0],his[1],his[3],his[2]] for his in traj_seqs['historical_addr'][-his_addresses_len:]]+[[his[0],his[1],his[3],his[2]] for his in traj_seqs['context_addr']]
@@ -32,7 +36,8 @@ class SpatialWorld:
         self.explore_num = explore_num
 
         # the world model can be a structured dictionary
-        self.world_model = self.build_inner_world_model()
+        # build_world=False defers the LLM calls, call abuild_inner_world_model() from an event loop instead
+        self.world_model = self.build_inner_world_model() if build_world else {}
 
 
     def get_world_info(self):
@@ -48,20 +53,30 @@ class SpatialWorld:
             return world_info_prompt[-self.max_lens:]
 
 
-   # build the initial world model by LLM itself
-    def build_inner_world_model(self):
-        world_info = {}
-
+    def world_model_prompts(self):
         subdistrict_pre = f"This trajectory moves within following administrative areas:\n{self.administrative_area}\nThis trajectory sequentially visited following subdistricts, with the last subdistrict being the most recently visited:\n"+";".join([str(item) for item in self.subdistrict])
         poi_pre = "This trajectory sequentially visited following POIs(Each POI is represented by 'POI name, the feeder road or access road it is on'), with the last POI being the most recently visited:\n"+";".join([str(item) for item in self.poi])
         subdistrict_post = "Consider about following two aspects:\n1.The frequency each subdistrict is visited.\n2.Transition probability between two administrative areas.\nPlease predict the next subdistrict in the trajectory. Give {} subdistricts that are relatively likely to be visited. Do not output other content.".format(self.explore_num)
         poi_post = "Consider about following two aspects:\n1.The frequency each subdistrict is visited\n2.The frequency each poi is visited\n3.Transition probability between two subdistricts.\n4.Transition probability between two pois.Please predict the next poi in the trajectory.Give {} POIs that are relatively likely to be visited. Do not output other content.".format(self.explore_num)
 
+        return {"subdistrict": subdistrict_pre+subdistrict_post, "poi": poi_pre+poi_post}
 
-        world_info["subdistrict"] =  self.llm.get_response(prompt_text=subdistrict_pre+subdistrict_post)
-        world_info["poi"] =  self.llm.get_response(prompt_text=poi_pre+poi_post)     
+   # build the initial world model by LLM itself
+    def build_inner_world_model(self, executor=None):
+        # the subdistrict and poi queries are independent, with an executor they run side by side
+        prompts = self.world_model_prompts()
+        if executor is None:
+            return {key: self.llm.get_response(prompt_text=prompt_text) for key, prompt_text in prompts.items()}
+        futures = {key: executor.submit(self.llm.get_response, prompt_text=prompt_text) for key, prompt_text in prompts.items()}
+        world_info = {key: future.result() for key, future in futures.items()}
         return world_info  #world_info
 
+    async def abuild_inner_world_model(self):
+        prompts = self.world_model_prompts()
+        responses = await asyncio.gather(*[self.llm.aget_response(prompt_text=prompt_text) for prompt_text in prompts.values()])
+        self.world_model = dict(zip(prompts.keys(), responses))
+        return self.world_model
+
     # build the world model by training data and other trajectories
     def build_inner_world_model_v2(self):
         return {}
@@ -75,112 +90,262 @@ class SocialWorld:
     """
     Collective Knowledge Extractor
     """
-    def __init__(self, traj_dataset, save_dir, city_name, khop=1, max_neighbors=10) -> None:
+    def __init__(self, traj_dataset, save_dir, city_name, khop=1, max_neighbors=10, neighbor_cache_size=10000, compact_every=1000,
+                 train_instances=None) -> None:
         self.save_dir = save_dir
         self.city_name = city_name
-        self.save_name = "{}_graph.gml".format(city_name)
+        self.save_name = "{}_graph.npz".format(city_name)
         self.graph_file_path = os.path.join(self.save_dir, self.save_name)
+        self.transitions_file_path = os.path.join(self.save_dir, "{}_transitions.npz".format(city_name))
+        # write-ahead log of update() calls not yet compacted into the .npz files
+        self.wal_file_path = os.path.join(self.save_dir, "{}_graph.wal".format(city_name))
+        self.compact_every = compact_every
 
         self.khop = khop
         self.max_neighbors = max_neighbors
 
-        test_dataset, _ = traj_dataset.get_generated_datasets()
-        self.get_processed_graph(test_dataset)
+        self.get_processed_graph(traj_dataset, train_instances)
+        # 1-hop neighbors are a sorted CSR slice, multi-hop expansions are cached per venue
+        self.khop_neighbors = lru_cache(maxsize=neighbor_cache_size)(self.expand_neighbors)
+        self.replay_wal()
+
+
+    @classmethod
+    def from_stays(cls, train_instances, save_dir, city_name, **kwargs):
+        """SocialWorld of stay lists already in memory (one list per user, like get_train_instances), e.g. for benchmarks"""
+        return cls(None, save_dir, city_name, train_instances=train_instances, **kwargs)
 
 
-    def build_graph(self, traj_dataset):
-        edges_list = []
-        nodes_list = []
-        for uid in traj_dataset.keys():
-            traj_ids = list(traj_dataset[uid].keys())
+    @staticmethod
+    def get_train_instances(traj_dataset):
+        train_instances = []
+        for uid, user_trajs in traj_dataset.iter_users():
+            traj_ids = list(user_trajs.keys())
             if len(traj_ids) == 0:
                 continue
             traj_id = traj_ids[0]
-            train_instance = traj_dataset[uid][traj_id]["historical_stays_long"]
-            venue_ids = [x[3] for x in train_instance] # venue_id
-            nodes_list.append([[x[3], x[2], x[4], x[5], x[6], x[7]] for x in train_instance]) # ['hour', 'weekday', 'venue_category_name', venue_id_type, "admin", "subdistrict", "poi", "street"]
-            traj_edges = list(zip(venue_ids[:-1], venue_ids[1:]))
-            edges_list.append(traj_edges)
-
-        edges = list(itertools.chain.from_iterable(edges_list))
-        nodes = list(itertools.chain.from_iterable(nodes_list))
-        nodes_df = pd.DataFrame(data=nodes, columns=["venue_id", "venue_category_name",  "admin", "subdistrict", "poi", "street"])
-
-        edges_weights = list(Counter(edges).items())
-        edges_final = []
-        for edge in edges_weights:
-            edges_final.append([edge[0][0], edge[0][1], edge[1]])
-        edges_df = pd.DataFrame(edges_final, columns=["src", "dst", "weight"])
-        self.graph = nx.from_pandas_edgelist(df=edges_df, source="src", target="dst", edge_attr=["weight"])
-        
-        for _, row in nodes_df.iterrows():
-            node = row['venue_id']
-            self.graph.nodes[node]['category'] = row['venue_category_name']
-            self.graph.nodes[node]['admin'] = row['admin']
-            self.graph.nodes[node]['subdistrict'] = row['subdistrict']
-            self.graph.nodes[node]["street"] = row["street"]
-            self.graph.nodes[node]['poi'] = row['poi']
-        
-        nx.write_gml(self.graph, self.graph_file_path)
+            train_instances.append(user_trajs[traj_id]["historical_stays_long"])
+        return train_instances
+
+
+    def build_graph(self, train_instances):
+        stays = list(itertools.chain.from_iterable(train_instances))
+        # ['hour', 'weekday', 'venue_category_name', venue_id_type, "admin", "subdistrict", "poi", "street"]
+        nodes_df = pd.DataFrame(data=[x[2:8] for x in stays], columns=["category", "venue_id", "admin", "subdistrict", "poi", "street"])
+        venue_codes, venue_ids = pd.factorize(nodes_df["venue_id"].astype(str))
+
+        # transitions between consecutive stays of one user, counted with np.unique
+        traj_ids = np.repeat(np.arange(len(train_instances)), [len(x) for x in train_instances])
+        same_traj = traj_ids[:-1] == traj_ids[1:]
+        edge_keys, edge_counts = np.unique(venue_codes[:-1][same_traj] * len(venue_ids) + venue_codes[1:][same_traj], return_counts=True)
+
+        # attributes of the last stay at each venue
+        nodes_df["code"] = venue_codes
+        nodes_df = nodes_df.drop_duplicates("code", keep="last").sort_values("code").astype(str)
+        attrs = {attr: nodes_df[attr].values.astype(str) for attr in NODE_ATTRS}
 
+        self.graph = VenueGraph.from_arrays(
+            np.asarray(venue_ids, dtype=str), edge_keys // max(len(venue_ids), 1), edge_keys % max(len(venue_ids), 1), edge_counts, attrs
+        )
+        self.graph.save(self.graph_file_path)
 
-    def get_processed_graph(self, traj_dataset):
+
+    def build_transitions(self, train_instances):
+        self.transitions = TransitionIndex.from_stays(self.graph.node_index, train_instances)
+        self.transitions.save(self.transitions_file_path)
+
+
+    def get_processed_graph(self, traj_dataset, train_instances=None):
+        """train_instances: stay lists of the users, read from traj_dataset when None"""
+        graph_built = False
         for file in glob.glob(os.path.join(self.save_dir, "*")):
             if self.save_name in file:
                 print("Loading existing graph from:{}".format(file))
-                self.graph = nx.read_gml(self.graph_file_path)
+                self.graph = VenueGraph.load(self.graph_file_path)
                 break
         else:
             print("Building new graph in:{}".format(self.graph_file_path))
-            self.build_graph(traj_dataset)
+            if train_instances is None:
+                train_instances = self.get_train_instances(traj_dataset)
+            self.build_graph(train_instances)
+            graph_built = True
+
+        self.transitions = None
+        if not graph_built and os.path.exists(self.transitions_file_path):
+            self.transitions = TransitionIndex.load(self.transitions_file_path)
+            if self.transitions.num_venues() > len(self.graph):
+                self.transitions = None
+        if self.transitions is None:
+            print("Building new transition index in:{}".format(self.transitions_file_path))
+            if train_instances is None:
+                train_instances = self.get_train_instances(traj_dataset)
+            self.build_transitions(train_instances)
+
+
+    def apply_update(self, stays, to_graph=True, to_transitions=True):
+        if to_graph:
+            nodes = [self.graph.add_venue(x[3], {"category": x[2], "admin": x[4], "subdistrict": x[5], "poi": x[6], "street": x[7]}) for x in stays]
+            for i, j in zip(nodes[:-1], nodes[1:]):
+                self.graph.add_edge(i, j)
+        else:
+            nodes = [self.graph.index(x[3]) for x in stays]
+        if to_transitions:
+            for i, j, stay in zip(nodes[:-1], nodes[1:], stays[1:]):
+                self.transitions.add(i, j, stay[0], stay[1])
+
+
+    def replay_wal(self):
+        self.wal_seq = max(self.graph.applied_seq, self.transitions.applied_seq)
+        self.wal_pending = 0
+        if not os.path.exists(self.wal_file_path):
+            return
+        with open(self.wal_file_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # torn last line of a crashed write
+                    break
+                seq = record["seq"]
+                if seq > min(self.graph.applied_seq, self.transitions.applied_seq):
+                    self.apply_update(record["stays"], seq > self.graph.applied_seq, seq > self.transitions.applied_seq)
+                    self.wal_pending += 1
+                self.wal_seq = max(self.wal_seq, seq)
+        if self.wal_pending > 0:
+            print("Replayed {} social world updates from:{}".format(self.wal_pending, self.wal_file_path))
+        self.khop_neighbors.cache_clear()
+
+
+    def update(self, stays):
+        """
+        Append the transitions of newly observed consecutive stays ([hour, weekday, category, venue_id, admin,
+        subdistrict, poi, street], as in historical_stays_long). The update is logged to the write-ahead log
+        before it is applied, and every compact_every updates the log is compacted into the base graph.
+        """
+        if len(stays) == 0:
+            return
+        self.wal_seq += 1
+        with open(self.wal_file_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"seq": self.wal_seq, "stays": [list(x[:8]) for x in stays]}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.apply_update(stays)
+        self.khop_neighbors.cache_clear()
+        self.wal_pending += 1
+        if self.compact_every > 0 and self.wal_pending >= self.compact_every:
+            self.compact()
+
+
+    def compact(self):
+        """fold the logged updates into the base graph and transition index files and truncate the log"""
+        self.graph.compact(self.wal_seq)
+        self.transitions.compact(len(self.graph), self.wal_seq)
+        self.graph.save(self.graph_file_path)
+        self.transitions.save(self.transitions_file_path)
+        open(self.wal_file_path, "w").close()
+        self.wal_pending = 0
+        self.khop_neighbors.cache_clear()
 
 
-    def retrival_neighbors(self, venue_id, context_trajs):
+    def expand_neighbors(self, node):
+        return tuple(self.graph.khop_neighbors(node, self.khop))
+
+    def retrival_neighbors(self, venue_id, context_trajs, topk=None):
+        """[(venue_id, hop, weight)] of the venues people moved to from venue_id, highest weight first within each hop"""
         try:
-            if venue_id not in self.graph.nodes():
+            node = self.graph.index(venue_id)
+            if node is None:
                 return []
+            if self.khop==1:
+                neighbors, weights = self.graph.neighbors(node)
+                candidates = ((n, 1, w) for n, w in zip(neighbors.tolist(), weights.tolist()))
             else:
-                if self.khop==1:
-                    neighbors = list(self.graph.neighbors(venue_id))
-                    sorted_neighbors_freq = [(n, 1) for n in neighbors if n not in context_trajs]
-                else:
-                    lengths = nx.single_source_shortest_path_length(self.graph, venue_id, cutoff=self.khop)
-                    neighbors = [(neighbor, length) for neighbor, length in lengths.items() if (1 <= length <= self.khop) and (neighbor not in context_trajs)]
-                    sorted_neighbors_freq = sorted(neighbors, key=lambda x: x[1])
+                candidates = self.khop_neighbors(node)
 
+            context_trajs = set(str(x) for x in context_trajs)
+            sorted_neighbors_freq = []
+            for n, hop, weight in candidates:
+                neighbor_id = str(self.graph.venue_id(n))
+                if neighbor_id in context_trajs:
+                    continue
+                sorted_neighbors_freq.append((neighbor_id, hop, weight))
+                if topk is not None and len(sorted_neighbors_freq) >= topk:
+                    break
             return sorted_neighbors_freq
         except:
             return []
 
 
-    def get_world_info(self, venue_id, context_traj, type="all"):
-        neighbors_sorted = self.retrival_neighbors(venue_id, context_traj)
+    def retrival_transitions(self, venue_id, context_trajs, hour, weekday, topk=None):
+        """[(venue_id, count)] people moved to from venue_id in the time slot of (hour, weekday), highest count first"""
+        try:
+            node = self.graph.index(venue_id)
+            if node is None:
+                return []
+            next_venues, counts = self.transitions.transitions(node, hour, weekday)
+            context_trajs = set(str(x) for x in context_trajs)
+            results = []
+            for n, count in zip(next_venues.tolist(), counts.tolist()):
+                neighbor_id = str(self.graph.venue_id(n))
+                if neighbor_id in context_trajs:
+                    continue
+                results.append((neighbor_id, count))
+                if topk is not None and len(results) >= topk:
+                    break
+            return results
+        except:
+            return []
+
+
+    def format_venue(self, n, type):
+        node = self.graph.node(self.graph.index(n))
+        category = node["category"]
+        street = node["street"]
+        poi = node["poi"]
+
+        if type=="all":
+            info = ",".join([n, category, street, poi])
+        elif type=="category":
+            info = category
+        elif type=="address":
+            info = ",".join([street, poi])
+        elif type=="id":
+            info = n
+        else:
+            info = ",".join([n, category, street, poi])
+        return info
+
+
+    def get_world_info(self, venue_id, context_traj, type="all", target_time=None):
+        """
+        target_time: (hour, weekday) of the stay to predict. When given, the places people moved to in that time slot
+        (directed transition index) come first and the weighted neighbors fill the remaining places.
+        """
+        prompts = []
+        listed = set()
+        if target_time is not None:
+            transitions = self.retrival_transitions(venue_id, context_traj, target_time[0], target_time[1], topk=self.max_neighbors + 1)
+            if len(transitions) > 0:
+                infos = [self.format_venue(n, type) for n, _ in transitions]
+                prompts.append("""Places people moved to next from this place around {} on {} in the social world:\n {}""".format(
+                    target_time[0], "weekends" if target_time[1] in WEEKEND_DAYS else "weekdays", "\n".join(infos)))
+                listed.update(n for n, _ in transitions)
+
+        # max_neighbors + 1 places in all as without target_time, at most the transitions listed above are skipped here
+        neighbors_sorted = self.retrival_neighbors(venue_id, context_traj, topk=self.max_neighbors + 1)
         neighbors_info = {}
-        count = 0
-        for n, f in neighbors_sorted:
-            category = self.graph.nodes[n]["category"]
-            street = self.graph.nodes[n]["street"]
-            poi = self.graph.nodes[n]["poi"]
-            
-            if type=="all":
-                info = ",".join([n, category, street, poi])
-            elif type=="category":
-                info = category
-            elif type=="address":
-                info = ",".join([street, poi])
-            elif type=="id":
-                info = n
-            else:
-                info = ",".join([n, category, street, poi])
+        for n, f, _ in neighbors_sorted:
+            if len(listed) > self.max_neighbors:
+                break
+            if n in listed:
+                continue
+            listed.add(n)
+            info = self.format_venue(n, type)
             
             if f in neighbors_info:
                 neighbors_info[f].append(info)
             else:
                 neighbors_info[f] = [info]
-            if count >=self.max_neighbors:
-                break
-            count += 1
-        prompts = []
         for f in neighbors_info:
             prompt_text = """{}-hop neighbor places in the social world:\n {}""".format(f, "\n".join(neighbors_info[f]))
             prompts.append(prompt_text)
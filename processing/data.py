@@ -10,11 +10,82 @@ from datetime import datetime, timedelta
 
 import utils
 from config import DATASET, CITY_DATA_DIR, OFFSET_DICT, PROCESSED_DIR
+from processing.processed_store import STORE_EXT, write_processed_store, load_processed_store
 import pickle
 import random
 import argparse
 
 
+def group_by_time_window(data, hour_bins):
+    """
+    Reference (row by row) time-window segmentation of one user's stays, kept for equivalence tests of
+    segment_time_windows. Use as data.groupby('user_id').apply(group_by_time_window, hour_bins).
+    """
+    # Sort by timestamp
+    data = data.sort_values('datetime')
+    # Start time for the first group
+    start_time = data.iloc[0]['datetime']
+    # Initialize trajectory ID
+    trajectory_id = 0
+    time_window = pd.Timedelta(hours=hour_bins)
+    for i in range(1, len(data)):
+        # If the current timestamp is outside the 72-hour window, increment the trajectory ID
+        if data.iloc[i]['datetime'] > start_time + time_window:
+            trajectory_id += 1
+            start_time = data.iloc[i]['datetime']
+        data.iloc[i, data.columns.get_loc('traj_id')] = trajectory_id
+
+    return data
+
+
+def segment_time_windows(user_ids, datetimes, hour_bins):
+    """
+    Vectorized equivalent of group_by_time_window for rows already sorted by (user_id, datetime).
+
+    A trajectory starts at the first stay of a user and ends at the last stay within hour_bins hours of its
+    start; the next stay opens a new trajectory and resets the window. Trajectory ids restart from 0 for
+    every user. Each step finds the next window start of every user at once with a vectorized binary search,
+    so the number of Python iterations is the largest number of trajectories of one user, not the number of rows.
+    """
+    times = pd.to_datetime(pd.Series(datetimes), utc=True).values.astype('datetime64[ns]').view('int64')
+    user_ids = np.asarray(user_ids)
+    n = len(times)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    window = pd.Timedelta(hours=hour_bins).value
+
+    # first and one-past-last row of every user
+    user_first = np.flatnonzero(np.r_[True, user_ids[1:] != user_ids[:-1]])
+    user_end = np.r_[user_first[1:], n]
+
+    is_start = np.zeros(n, dtype=bool)
+    is_start[user_first] = True
+    starts = user_first
+    ends = user_end
+    while len(starts) > 0:
+        # first row in (start, end) whose time is after the window of the current start
+        limit = times[starts] + window
+        lo = starts + 1
+        hi = ends.copy()
+        while True:
+            active = lo < hi
+            if not active.any():
+                break
+            mid = (lo + hi) // 2
+            after = np.zeros(len(mid), dtype=bool)
+            after[active] = times[mid[active]] > limit[active]
+            hi = np.where(active & after, mid, hi)
+            lo = np.where(active & ~after, mid + 1, lo)
+        found = lo < ends
+        starts = lo[found]
+        ends = ends[found]
+        is_start[starts] = True
+
+    # running count of window starts within each user, from 0
+    counts = np.cumsum(is_start)
+    return counts - np.repeat(counts[user_first], user_end - user_first)
+
+
 class Dataset:
 
     def __init__(self, base_name="AgentMove", dataset_name='nyc', trajectory_mode='trajectory_split', historical_stays=40, context_stays=6,
@@ -57,8 +128,9 @@ class Dataset:
             print('Computing trajectories...')
             self.get_trajectories()
         else:
-            self.test_dictionary = json.load(open(os.path.join(self.save_dir, self.processed_datasets[dataset_name]["test"])))
-            self.true_locations = json.load(open(os.path.join(self.save_dir, self.processed_datasets[dataset_name]["true"])))
+            # memory-mapped, users are decoded on access
+            self.test_dictionary = load_processed_store(os.path.join(self.save_dir, self.processed_datasets[dataset_name]["test"]))
+            self.true_locations = load_processed_store(os.path.join(self.save_dir, self.processed_datasets[dataset_name]["true"]))
 
 
     def get_encode(self, df):
@@ -241,12 +313,17 @@ class Dataset:
     def get_processed_datasets(self):
         for x in glob.glob(os.path.join(self.save_dir, "*")):
             file_name = x.split(os.sep)[-1]
+            if not file_name.endswith((".json", STORE_EXT)):
+                continue
             if "test" in file_name or "true" in file_name:
                 if self.use_int_venue and ("int" not in file_name):
                     continue
                 city_name = file_name.split("_")[2]
                 file_type = file_name.split("_")[0]
                 if city_name in self.processed_datasets:
+                    # legacy .json files are only used when there is no binary store
+                    if file_name.endswith(".json") and self.processed_datasets[city_name].get(file_type, "").endswith(STORE_EXT):
+                        continue
                     self.processed_datasets[city_name][file_type] = file_name
                 else:
                     self.processed_datasets[city_name] = {file_type: file_name}
@@ -254,6 +331,21 @@ class Dataset:
     def get_generated_datasets(self):
         return self.test_dictionary, self.true_locations
 
+    def get_user_ids(self):
+        return list(self.test_dictionary.keys())
+
+    def get_user(self, user_id):
+        """{traj_id: record} of one user, decoded from the processed store on access"""
+        return self.test_dictionary[str(user_id)]
+
+    def get_ground_truth(self, user_id):
+        return self.true_locations[str(user_id)]
+
+    def iter_users(self):
+        """Stream (user_id, {traj_id: record}) one user at a time"""
+        for user_id in self.get_user_ids():
+            yield user_id, self.get_user(user_id)
+
 
     def get_dataset(self):
         """
@@ -489,30 +581,13 @@ class Dataset:
 
         elif self.trajectory_mode == 'trajectory_split':
 
-            def _group_by_time_window(data):
-                # Sort by timestamp
-                data = data.sort_values('datetime')
-                # Start time for the first group
-                start_time = data.iloc[0]['datetime']
-                # Initialize trajectory ID
-
-                trajectory_id = self.data['traj_id'].max()
-                time_window = pd.Timedelta(hours=self.hour_bins)
-                for i in range(1, len(data)):
-                    # If the current timestamp is outside the 72-hour window, increment the trajectory ID
-                    if data.iloc[i]['datetime'] > start_time + time_window:
-                        trajectory_id += 1
-                        start_time = data.iloc[i]['datetime']
-                    data.iloc[i, data.columns.get_loc('traj_id')] = trajectory_id
-
-                return data
-
             if self.dataset_name in ["Shanghai"]:
                 pass
             else:
                 # Applying the function to group by ID and then by time window
                 self.data['traj_id'] = 0
-                self.data = self.data.groupby('user_id').apply(_group_by_time_window).reset_index(drop=True)
+                self.data = self.data.reset_index(drop=True)
+                self.data['traj_id'] = segment_time_windows(self.data['user_id'].values, self.data['datetime'], self.hour_bins)
             
 
             ################## add processing for running DL baselines
@@ -550,17 +625,36 @@ class Dataset:
             DL_train_trajectory_ids = []
             DL_val_trajectory_ids = []
             DL_test_trajectory_ids = []
+
+            # Slice every column group once for the whole table, then address each user by its row positions
+            # (one groupby) instead of rescanning the full table with boolean masks for every trajectory
+            venue_id_type = "venue_id_int" if self.use_int_venue else "venue_id"
+            cared_column_list = ['hour', 'weekday', 'venue_category_name', venue_id_type, "admin", "subdistrict", "poi", "street"]
+            addres_column_list = ["admin", "subdistrict", "poi", "street"]
+            coor_column_list = ['longitude', 'latitude']
+            align_columns = ["city", "user_id", "venue_id", "utc_time","longitude", "latitude", "venue_category_name", "venue_id_int"]
+            traj_values = self.data['traj_id'].values
+            if self.base_name == 'AgentMove':
+                cared_values = self.data[cared_column_list].values
+                addr_values = self.data[addres_column_list].values
+                pos_values = self.data[coor_column_list].values
+                align_values = self.data[align_columns].values
+            user_rows = self.data.groupby('user_id', sort=False).indices
+
             for user_id in tqdm.tqdm(self.data['user_id'].unique()):
                 # put the user in the dictionaries
                 self.test_dictionary[str(user_id)] = {}
                 self.true_locations[str(user_id)] = {}
                 self.align_dictionary[str(user_id)] = {}
 
+                rows = user_rows[user_id]
+                user_traj_values = traj_values[rows]
+                trajectory_ids = pd.unique(user_traj_values)
+
                 # exclude users with less than traj_min_len trajectories id
-                if len(self.data[self.data['user_id'] == user_id]['traj_id'].unique()) < self.traj_min_len:
+                if len(trajectory_ids) < self.traj_min_len:
                     continue
 
-                trajectory_ids = self.data[self.data['user_id'] == user_id]['traj_id'].unique()
                 if self.dataset_name in ["Shanghai", "Shanghai_Weibo"]:# WWW2019 Shanghai-ISP
                     train_trajectory_ids = trajectory_ids[:int(0.5 * len(trajectory_ids))]
                     test_trajectory_ids = trajectory_ids[int(0.5 * len(trajectory_ids)):]
@@ -578,26 +672,24 @@ class Dataset:
                 # (location ids and time from training) and the context stays (location ids and time
                 # from testing with specific trajectory id)
 
+                # the historical rows are the same for every test trajectory of the user
+                historical_rows = rows[np.isin(user_traj_values, train_trajectory_ids)]
                 test_ids = []
                 for i, trajectory_id in enumerate(test_trajectory_ids):
+                    context_rows = rows[user_traj_values == trajectory_id]
                     # exclude this trajectory if it has less than 4 stays
-                    if len(self.data[(self.data['user_id'] == user_id) & (self.data['traj_id'] == trajectory_id)]) < 4:
+                    if len(context_rows) < 4:
                         continue
                     
                     test_ids.append(trajectory_id)
                     if self.base_name == 'AgentMove': # default data processing for LLM based methods, all llm methods use this
-                        venue_id_type = "venue_id_int" if self.use_int_venue else "venue_id" 
-                        cared_column_list = ['hour', 'weekday', 'venue_category_name', venue_id_type, "admin", "subdistrict", "poi", "street"]
-                        addres_column_list = ["admin", "subdistrict", "poi", "street"]
-                        coor_column_list = ['longitude', 'latitude']
-
-                        historical_data = self.data[(self.data['user_id'] == user_id) & (self.data['traj_id'].isin(train_trajectory_ids))][cared_column_list].values
-                        historical_addr = self.data[(self.data['user_id'] == user_id) & (self.data['traj_id'].isin(train_trajectory_ids))][addres_column_list].values
-                        historical_pos  = self.data[(self.data['user_id'] == user_id) & (self.data['traj_id'].isin(train_trajectory_ids))][coor_column_list].values
+                        historical_data = cared_values[historical_rows]
+                        historical_addr = addr_values[historical_rows]
+                        historical_pos  = pos_values[historical_rows]
 
-                        context_data = self.data[(self.data['user_id'] == user_id) & (self.data['traj_id'] == trajectory_id)][cared_column_list].values
-                        context_addr = self.data[(self.data['user_id'] == user_id) & (self.data['traj_id'] == trajectory_id)][addres_column_list].values
-                        context_pos  = self.data[(self.data['user_id'] == user_id) & (self.data['traj_id'] == trajectory_id)][coor_column_list].values
+                        context_data = cared_values[context_rows]
+                        context_addr = addr_values[context_rows]
+                        context_pos  = pos_values[context_rows]
 
                         ground_truth = context_data[-1][3]
                         ground_pos = context_pos[-1]
@@ -628,9 +720,8 @@ class Dataset:
                             'ground_addr':ground_addr.tolist(),
                         }
 
-                        align_columns = ["city", "user_id", "venue_id", "utc_time","longitude", "latitude", "venue_category_name", "venue_id_int"]
-                        historical_data_align = self.data[(self.data['user_id'] == user_id) & (self.data['traj_id'].isin(train_trajectory_ids))][align_columns].values
-                        context_data_align = self.data[(self.data['user_id'] == user_id) & (self.data['traj_id'] == trajectory_id)][align_columns].values
+                        historical_data_align = align_values[historical_rows]
+                        context_data_align = align_values[context_rows]
                         alignment_data = {
                             "historical_stays_long": historical_data_align.tolist(),
                             "context_stays": context_data_align.tolist()
@@ -666,12 +757,9 @@ class Dataset:
         if self.use_int_venue:
             extra_file_name = "_int"
         utils.create_dir(self.save_dir)
-        with open(os.path.join(self.save_dir, 'test_dictionary_'+self.dataset_name+'_'+self.trajectory_mode+extra_file_name+'.json'), 'w') as f:
-            json.dump(self.test_dictionary, f)
-        with open(os.path.join(self.save_dir, 'true_locations_'+self.dataset_name+'_'+self.trajectory_mode+extra_file_name+'.json'), 'w') as f:
-            json.dump(self.true_locations, f)
-        with open(os.path.join(self.save_dir, 'align_locations_'+self.dataset_name+'_'+self.trajectory_mode+extra_file_name+'.json'), 'w') as f:
-            json.dump(self.align_dictionary, f)
+        write_processed_store(os.path.join(self.save_dir, 'test_dictionary_'+self.dataset_name+'_'+self.trajectory_mode+extra_file_name), self.test_dictionary)
+        write_processed_store(os.path.join(self.save_dir, 'true_locations_'+self.dataset_name+'_'+self.trajectory_mode+extra_file_name), self.true_locations)
+        write_processed_store(os.path.join(self.save_dir, 'align_locations_'+self.dataset_name+'_'+self.trajectory_mode+extra_file_name), self.align_dictionary)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,68 @@
+import os
+import json
+from collections.abc import Mapping
+
+import numpy as np
+
+
+STORE_EXT = ".bin"
+INDEX_EXT = ".idx.npz"
+
+
+def write_processed_store(path, dictionary):
+    """
+    Save a processed {user_id: record} dictionary as one binary file plus a per-user offset index.
+
+    path is the file name without extension, e.g. data/processed/test_dictionary_Tokyo_trajectory_split.
+    Every user record is encoded separately, so a reader only decodes the users it touches.
+    """
+    user_ids = []
+    offsets = [0]
+    with open(path + STORE_EXT, "wb") as f:
+        for user_id, record in dictionary.items():
+            data = json.dumps(record, ensure_ascii=False).encode("utf-8")
+            f.write(data)
+            user_ids.append(str(user_id))
+            offsets.append(offsets[-1] + len(data))
+    np.savez(path + INDEX_EXT, users=np.array(user_ids, dtype=str), offsets=np.array(offsets, dtype=np.int64))
+
+
+class ProcessedStore(Mapping):
+    """
+    Read-only, memory-mapped {user_id: record} view of a store written by write_processed_store.
+
+    Only the offset index is loaded at startup; the record of a user is decoded from the mapped file when
+    it is accessed and is not kept, so memory stays flat however large the city is.
+    """
+    def __init__(self, path):
+        self.path = path
+        index = np.load(path + INDEX_EXT)
+        self.offsets = index["offsets"]
+        self.user_index = {user_id: i for i, user_id in enumerate(index["users"].tolist())}
+        if self.offsets[-1] > 0:
+            self.data = np.memmap(path + STORE_EXT, dtype=np.uint8, mode="r")
+        else:
+            self.data = np.zeros(0, dtype=np.uint8)
+
+    def __getitem__(self, user_id):
+        i = self.user_index[str(user_id)]
+        return json.loads(self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8"))
+
+    def __contains__(self, user_id):
+        return str(user_id) in self.user_index
+
+    def __iter__(self):
+        return iter(self.user_index)
+
+    def __len__(self):
+        return len(self.user_index)
+
+
+def load_processed_store(file_path):
+    """Open a processed .bin store, or convert a legacy .json file into one first and open that."""
+    if file_path.endswith(STORE_EXT):
+        return ProcessedStore(file_path[:-len(STORE_EXT)])
+    path = os.path.splitext(file_path)[0]
+    with open(file_path) as f:
+        write_processed_store(path, json.load(f))
+    return ProcessedStore(path)
@@ -1,7 +1,9 @@
 import os
 import json
+import time
 import asyncio
 import argparse
+from contextlib import asynccontextmanager
 from typing import List, Optional
 
 
@@ -53,8 +55,7 @@ POI JSON:
 """
 
 
-async def _fetch_pois_via_mcp(
-    repo_root: str,
+def _build_tool_args(
     lat: float,
     lon: float,
     radius_m: int,
@@ -66,31 +67,200 @@ async def _fetch_pois_via_mcp(
     compact: bool,
     include_tags: bool,
 ) -> dict:
-    server = StdioServerParameters(
+    args = {
+        "lat": lat,
+        "lon": lon,
+        "radius_m": radius_m,
+        "limit": limit,
+        "timeout_overpass_s": timeout_overpass_s,
+        "split_by_key": split_by_key,
+        "compact": compact,
+        "include_tags": include_tags,
+    }
+    if poi_keys is not None:
+        args["poi_keys"] = poi_keys
+    if name_query is not None:
+        args["name_query"] = name_query
+    return args
+
+
+# POI backend settings read by mcp_servers/osm_poi_server.py, forwarded to the server subprocess
+SERVER_ENV_VARS = ["OSM_POI_INDEX_PATH", "OSM_POI_CACHE_PATH", "OSM_POI_CACHE_TTL_DAYS", "OSM_POI_GEOHASH_PRECISION"]
+
+
+def _server_params(repo_root: str) -> StdioServerParameters:
+    return StdioServerParameters(
         command="python",
         args=["-m", "mcp_servers.osm_poi_server"],
-        env={"PYTHONPATH": repo_root},
+        env={"PYTHONPATH": repo_root, **{k: os.environ[k] for k in SERVER_ENV_VARS if k in os.environ}},
+    )
+
+
+class _PooledSession:
+    """
+    One osm_poi_server subprocess with an initialized ClientSession.
+    The stdio transport is entered and exited by a single background task, as anyio requires.
+    """
+
+    def __init__(self, server: StdioServerParameters):
+        self.server = server
+        self.session: Optional[ClientSession] = None
+        self.error: Optional[BaseException] = None
+        self.last_used = 0.0
+        self._ready = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+        await self._ready.wait()
+        if self.session is None:
+            raise RuntimeError(f"Failed to start MCP POI server: {self.error!r}")
+        self.last_used = time.monotonic()
+
+    async def _run(self) -> None:
+        try:
+            async with stdio_client(self.server) as (read_stream, write_stream):
+                async with ClientSession(read_stream, write_stream) as session:
+                    await session.initialize()
+                    self.session = session
+                    self._ready.set()
+                    await self._stop.wait()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.session = None
+            self._ready.set()
+
+    @property
+    def alive(self) -> bool:
+        return self.session is not None and self._task is not None and not self._task.done()
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            try:
+                await self._task
+            except Exception:
+                pass
+
+
+class MCPSessionPool:
+    """
+    A fixed-size pool of long-lived, initialized MCP sessions to the OSM POI server.
+
+    Spawning the server and running the MCP handshake once per prediction costs hundreds of
+    milliseconds, so the Agents engine leases sessions from this pool instead. Sessions idle for
+    longer than `health_check_interval_s` are pinged before being handed out, and a session that
+    fails a ping or raises during a lease is torn down and restarted on its next lease.
+
+    The pool lives on one event loop:
+        async with MCPSessionPool(repo_root, size=8) as pool:
+            result = await _fetch_pois_via_mcp(..., pool=pool)
+    """
+
+    def __init__(
+        self,
+        repo_root: str,
+        size: int = 4,
+        health_check_interval_s: float = 30.0,
+        ping_timeout_s: float = 5.0,
+    ):
+        self.server = _server_params(repo_root)
+        self.size = size
+        self.health_check_interval_s = health_check_interval_s
+        self.ping_timeout_s = ping_timeout_s
+        self.restarts = 0
+        self._slots: List[_PooledSession] = []
+        self._idle: Optional[asyncio.Queue] = None
+
+    async def __aenter__(self) -> "MCPSessionPool":
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.close()
+
+    async def start(self) -> None:
+        self._idle = asyncio.Queue()
+        self._slots = [_PooledSession(self.server) for _ in range(self.size)]
+        results = await asyncio.gather(*[slot.start() for slot in self._slots], return_exceptions=True)
+        errors = [r for r in results if isinstance(r, Exception)]
+        if errors:
+            await self.close()
+            raise errors[0]
+        for slot in self._slots:
+            self._idle.put_nowait(slot)
+
+    async def close(self) -> None:
+        await asyncio.gather(*[slot.stop() for slot in self._slots])
+        self._slots = []
+
+    async def _replace(self, slot: _PooledSession) -> _PooledSession:
+        await slot.stop()
+        new_slot = _PooledSession(self.server)
+        self._slots[self._slots.index(slot)] = new_slot
+        self.restarts += 1
+        return new_slot
+
+    async def _needs_restart(self, slot: _PooledSession) -> bool:
+        if not slot.alive:
+            return True
+        if time.monotonic() - slot.last_used > self.health_check_interval_s:
+            try:
+                await asyncio.wait_for(slot.session.send_ping(), timeout=self.ping_timeout_s)
+            except Exception:
+                return True
+        return False
+
+    @asynccontextmanager
+    async def lease(self):
+        slot = await self._idle.get()
+        broken = False
+        try:
+            if await self._needs_restart(slot):
+                slot = await self._replace(slot)
+                await slot.start()
+            yield slot.session
+        except BaseException:
+            broken = True
+            raise
+        finally:
+            if broken:
+                # do not hand a session with a half-read response to the next caller
+                await slot.stop()
+            slot.last_used = time.monotonic()
+            self._idle.put_nowait(slot)
+
+
+async def _fetch_pois_via_mcp(
+    repo_root: str,
+    lat: float,
+    lon: float,
+    radius_m: int,
+    poi_keys: Optional[List[str]],
+    name_query: Optional[str],
+    limit: int,
+    timeout_overpass_s: int,
+    split_by_key: bool,
+    compact: bool,
+    include_tags: bool,
+    pool: Optional[MCPSessionPool] = None,
+) -> dict:
+    args = _build_tool_args(
+        lat, lon, radius_m, poi_keys, name_query, limit, timeout_overpass_s, split_by_key, compact, include_tags
     )
 
+    if pool is not None:
+        async with pool.lease() as session:
+            result = await session.call_tool("get_nearby_pois", args)
+        return json.loads(result.content[0].text)
+
+    server = _server_params(repo_root)
     async with stdio_client(server) as (read_stream, write_stream):
         async with ClientSession(read_stream, write_stream) as session:
             await session.initialize()
 
-            args = {
-                "lat": lat,
-                "lon": lon,
-                "radius_m": radius_m,
-                "limit": limit,
-                "timeout_overpass_s": timeout_overpass_s,
-                "split_by_key": split_by_key,
-                "compact": compact,
-                "include_tags": include_tags,
-            }
-            if poi_keys is not None:
-                args["poi_keys"] = poi_keys
-            if name_query is not None:
-                args["name_query"] = name_query
-
             result = await session.call_tool("get_nearby_pois", args)
 
             text = result.content[0].text
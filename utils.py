@@ -12,6 +12,7 @@ import pandas as pd
 from sklearn.preprocessing import LabelEncoder
 from typing import Dict, Tuple
 from datetime import datetime
+from functools import lru_cache
 from math import radians, sin, cos, sqrt, atan2
 
 
@@ -201,9 +202,74 @@ def match_prediction(text, prediction_key="prediction"):
     return place_ids
 
 
+@lru_cache(maxsize=None)
+def get_token_encoder(model_name="gpt-3.5-turbo"):
+    """tiktoken encoding loaded once per process, None if it cannot be loaded (e.g. offline without a cached BPE file)"""
+    encoding = getattr(TokenCount(model_name=model_name), "encoding", None)
+    if encoding is None:
+        print("Tokenizer of {} is unavailable, token counts are estimated from text length".format(model_name))
+    return encoding
+
+
 def token_count(text):
-    tc = TokenCount(model_name="gpt-3.5-turbo")
-    return tc.num_tokens_from_string(text)
+    encoding = get_token_encoder()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+class PredictionStreamDetector:
+    """
+    Incremental scanner of a streamed response: feed() returns True once a complete JSON object with a
+    non-empty prediction list has been received, i.e. everything extract_json needs. Braces inside JSON
+    strings are skipped; every closed object is checked, so a stray "{" in reasoning text does not hide
+    the answer, and objects without a prediction key are ignored.
+    """
+    def __init__(self, prediction_keys=("prediction", "recommendation")):
+        self.prediction_keys = prediction_keys
+        self.text = []
+        self.length = 0
+        self.starts = []
+        self.in_string = False
+        self.escaped = False
+        self.result = None
+
+    def feed(self, delta):
+        if self.result is not None or not delta:
+            return self.result is not None
+        offset = self.length
+        self.text.append(delta)
+        self.length += len(delta)
+        for i, ch in enumerate(delta):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"' and self.starts:
+                self.in_string = True
+            elif ch == "{":
+                self.starts.append(offset + i)
+            elif ch == "}" and self.starts:
+                candidate = "".join(self.text)[self.starts.pop():offset + i + 1]
+                if any('"{}"'.format(key) in candidate for key in self.prediction_keys) and self.check(candidate):
+                    return True
+        return False
+
+    def check(self, json_str):
+        try:
+            output_json = json.loads(jsmin.jsmin(json_str))
+        except Exception:
+            return False
+        if not isinstance(output_json, dict):
+            return False
+        for key in self.prediction_keys:
+            if isinstance(output_json.get(key), list) and len(output_json[key]) > 0:
+                self.result = output_json
+                return True
+        return False
 
 
 def extract_json(full_text, prediction_key="prediction"):